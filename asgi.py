@@ -0,0 +1,3 @@
+from traderev.async_api import create_asgi_app
+
+app = create_asgi_app()
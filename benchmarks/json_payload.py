@@ -0,0 +1,68 @@
+"""Time serializing a trades payload with each JSON backend.
+
+    python -m benchmarks.json_payload --trades 100000
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+from flask import Flask
+from traderev.utils import JSONProvider, orjson
+
+def trades_payload(count: int):
+    """Trade documents as the trades endpoints return them.
+    """
+    rng = random.Random(1)
+    start = datetime(2022, 1, 3, 14, 30)
+    payload = []
+    for i in range(count):
+        opened = start + timedelta(minutes=i)
+        cost = -rng.randint(50, 500) * 1.0
+        profit = rng.randint(-200, 200) * 1.0
+        payload.append({
+            "_id": ObjectId(),
+            "symbol": f"SPY_{opened:%m%d%y}P{400 + i % 50}",
+            "underlying": "SPY",
+            "putcall": rng.choice(["PUT", "CALL"]),
+            "openingdate": opened,
+            "closingdate": opened + timedelta(hours=2),
+            "openingprice": cost,
+            "closingprice": profit - cost,
+            "profitdollars": profit,
+            "profitpercent": profit / abs(cost),
+            "totalcommission": 1.3,
+            "totalfees": 0.05,
+            "openingtransactions": [{"id": 2 * i, "amount": 1.0}],
+            "closingtransactions": [{"id": 2 * i + 1, "amount": 1.0}],
+            "openamount": 0,
+        })
+    return payload
+
+def time_backend(backend: str, payload, repeat: int):
+    """Best wall time of dumps_bytes over repeat runs, and the payload size.
+    """
+    app = Flask(__name__)
+    app.config['JSON_BACKEND'] = backend
+    provider = JSONProvider(app)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = provider.dumps_bytes(payload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--trades", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    payload = trades_payload(args.trades)
+    backends = ["orjson", "json"] if orjson else ["json"]
+    for backend in backends:
+        elapsed, size = time_backend(backend, payload, args.repeat)
+        print(f"{backend:7} {elapsed:6.2f}s  {size / 1e6:6.1f} MB")
+
+if __name__ == "__main__":
+    main()
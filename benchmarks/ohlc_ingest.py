@@ -0,0 +1,81 @@
+"""Measure OHLC ingest throughput in bars per second.
+
+    python -m benchmarks.ohlc_ingest --bars 200000 --batch-size 500 1000 5000
+    python -m benchmarks.ohlc_ingest --parse-only
+
+Without --parse-only the bars are inserted into the database of MONGO_INI
+under the symbol BENCH, and deleted again afterwards.
+"""
+import argparse
+import json
+import time
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from traderev.ingest import BarWriter, ingest, iter_records
+
+bench_symbol = "BENCH"
+
+def bar_lines(count: int, fmt: str):
+    """Encoded one minute bars, as an upload body would arrive.
+    """
+    start = datetime(2023, 1, 3, 14, 30)
+    if fmt == "csv":
+        yield b"symbol,timestamp,open,high,low,close,volume\n"
+    for i in range(count):
+        timestamp = (start + timedelta(minutes=i)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        price = 400 + (i % 300) / 100
+        if fmt == "csv":
+            line = f"{bench_symbol},{timestamp},{price},{price + 0.5},{price - 0.5},{price + 0.1},{i % 5000}"
+        else:
+            line = json.dumps({"symbol": bench_symbol, "timestamp": timestamp, "open": price,
+                               "high": price + 0.5, "low": price - 0.5,
+                               "close": price + 0.1, "volume": i % 5000})
+        yield line.encode() + b"\n"
+
+class ParseOnlyWriter(BarWriter):
+    """Builds the bar documents but drops the batches instead of inserting.
+    """
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if self.batch:
+            self.inserted += len(self.batch)
+            self.batches += 1
+            self.batch = []
+
+def parse_only(lines, fmt: str, batch_size: int):
+    writer = ParseOnlyWriter(batch_size)
+    for record in iter_records(lines, fmt):
+        writer.add(record)
+    writer.flush()
+    return writer.summary()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bars", type=int, default=200000)
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1000])
+    parser.add_argument("--parse-only", action="store_true",
+                        help="Only decode and convert the bars, without MongoDB.")
+    args = parser.parse_args()
+    if args.parse_only:
+        context = nullcontext
+    else:
+        from traderev import create_app, db
+        context = create_app().app_context
+    for batch_size in args.batch_size:
+        lines = list(bar_lines(args.bars, args.format))
+        with context():
+            start = time.perf_counter()
+            if args.parse_only:
+                summary = parse_only(lines, args.format, batch_size)
+            else:
+                summary = ingest(lines, args.format, batch_size)
+            elapsed = time.perf_counter() - start
+            if not args.parse_only:
+                db.db.ohlc.delete_many({"symbol": bench_symbol})
+        print(f"batch {batch_size:6}: {summary['inserted'] / elapsed:10.0f} bars/s  "
+              f"{elapsed:6.2f}s  {summary['batches']} batches, {summary['rejected']} rejected")
+
+if __name__ == "__main__":
+    main()
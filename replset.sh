@@ -0,0 +1,33 @@
+#!/bin/sh
+# Launch a local three member replica set for trying out read preference
+# routing. Data and logs go to ./replset, stop it with: ./replset.sh stop
+set -e
+BASE=${REPLSET_DIR:-./replset}
+PORTS="27017 27018 27019"
+
+if [ "$1" = "stop" ]; then
+    for port in $PORTS; do
+        mongosh --quiet --port "$port" --eval 'db.getSiblingDB("admin").shutdownServer()' || true
+    done
+    exit 0
+fi
+
+for port in $PORTS; do
+    mkdir -p "$BASE/$port"
+    mongod --replSet rs0 --port "$port" --bind_ip localhost \
+        --dbpath "$BASE/$port" --logpath "$BASE/$port.log" --fork
+done
+
+mongosh --quiet --port 27017 --eval '
+rs.initiate({_id: "rs0", members: [
+    {_id: 0, host: "localhost:27017", priority: 2},
+    {_id: 1, host: "localhost:27018"},
+    {_id: 2, host: "localhost:27019"}
+]})'
+
+echo "Replica set rs0 started, use this MONGO_INI:"
+echo "[default]"
+echo "mongo_uri=mongodb://localhost:27017,localhost:27018,localhost:27019/traderev?replicaSet=rs0"
+echo "[read_preference]"
+echo "analytics=secondaryPreferred"
+echo "max_staleness_seconds=90"
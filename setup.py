@@ -10,4 +10,8 @@ setup(
         "Flask-PyMongo",
         "pandas",
     ],
+    extras_require={
+        "async": ["Quart", "quart-cors", "hypercorn", "pymongo>=4.10"],
+        "test": ["pytest", "mongomock"],
+    },
 )
\ No newline at end of file
@@ -0,0 +1,48 @@
+import inspect
+import mongomock
+import pytest
+from werkzeug.local import LocalProxy
+from traderev import create_app
+from traderev import db as traderev_db
+
+# pymongo 4.11+ passes sort to bulk updates, which mongomock doesn't accept yet
+_add_update = mongomock.collection.BulkOperationBuilder.add_update
+if "sort" not in inspect.signature(_add_update).parameters:
+    def add_update(self, *args, sort=None, **kwargs):
+        return _add_update(self, *args, **kwargs)
+    mongomock.collection.BulkOperationBuilder.add_update = add_update
+
+def without_archive(collection, stages, after=()):
+    """with_archive without the $unionWith stage, which mongomock lacks.
+    """
+    return list(stages) + list(after)
+
+# transactiondate is stored as a date here, mongomock lacks $toDate
+convert_transactiondate = {
+    "$addFields": {"openDate": {"$dateToString": {"format": traderev_db.date_fmt,
+                                                  "date": "$transactiondate"}}}
+}
+
+@pytest.fixture
+def mongo_ini(tmp_path, monkeypatch):
+    path = tmp_path / "mongo.ini"
+    path.write_text("[default]\nmongo_uri=mongodb://localhost/traderev\n")
+    monkeypatch.setenv("MONGO_INI", str(path))
+    return path
+
+@pytest.fixture
+def database(monkeypatch):
+    database = mongomock.MongoClient().traderev
+    monkeypatch.setattr(traderev_db, "db", LocalProxy(lambda: database))
+    monkeypatch.setattr(traderev_db, "with_archive", without_archive)
+    monkeypatch.setattr(traderev_db, "convert_transactiondate", convert_transactiondate)
+    monkeypatch.setattr(traderev_db, "ensured_indexes", set())
+    return database
+
+@pytest.fixture
+def app(mongo_ini, database):
+    return create_app({"TESTING": True})
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,27 @@
+from traderev import db as traderev_db
+from traderev.compression import payload_cache
+
+def test_write_during_the_view_is_not_cached(client, monkeypatch):
+    payload_cache.clear()
+    # the first request persists the weeks of the year
+    client.get("/api/weeks/yearly?year=2022")
+    get_week_by_date = traderev_db.get_week_by_date
+    writes = []
+    def concurrent_write(day):
+        if not writes:
+            writes.append(traderev_db.add_tag_to_week("2022-12-26", "concurrent"))
+        return get_week_by_date(day)
+    monkeypatch.setattr(traderev_db, "get_week_by_date", concurrent_write)
+    client.get("/api/weeks/yearly?year=2022")
+    monkeypatch.setattr(traderev_db, "get_week_by_date", get_week_by_date)
+    weeks = client.get("/api/weeks/yearly?year=2022").get_json()
+    assert writes
+    assert weeks[-1]["start_date"] == "2022-12-26"
+    assert weeks[-1]["tags"] == ["concurrent"]
+
+def test_unchanged_versions_are_cached(client, monkeypatch):
+    payload_cache.clear()
+    client.get("/api/weeks/yearly?year=2022")
+    first = client.get("/api/weeks/yearly?year=2022").get_data()
+    monkeypatch.setattr(traderev_db, "get_week_by_date", None)
+    assert client.get("/api/weeks/yearly?year=2022").get_data() == first
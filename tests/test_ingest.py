@@ -0,0 +1,28 @@
+import json
+from traderev.ingest import BarWriter, iter_records
+
+bar = {"symbol": "SPY", "timestamp": "2023-01-03T14:30:00Z",
+       "open": 1, "high": 2, "low": 0.5, "close": 1.5, "volume": 100}
+
+def test_ndjson_bad_lines_are_rejected():
+    lines = [json.dumps(bar).encode() + b"\n", b"{not json\n", b"\xff\xfe\n", b"\n",
+             json.dumps(bar).encode() + b"\n"]
+    records = list(iter_records(lines, "ndjson"))
+    assert records == [bar, None, None, bar]
+
+def test_csv_undecodable_lines_are_rejected():
+    lines = [b"symbol,timestamp,open,high,low,close,volume\n",
+             b"SPY,2023-01-03T14:30:00Z,1,2,0.5,1.5,100\n",
+             b"SP\xff,2023-01-03T14:31:00Z,1,2,0.5,1.5,100\n",
+             b"SPY,2023-01-03T14:32:00Z,1,2,0.5,1.5,100\n"]
+    records = list(iter_records(lines, "csv"))
+    assert len(records) == 3
+    assert records[1] is None
+    assert records[2]["timestamp"] == "2023-01-03T14:32:00Z"
+
+def test_writer_counts_rejected_records():
+    writer = BarWriter(batch_size=10)
+    for record in [None, bar, {"symbol": "SPY"}]:
+        writer.add(record)
+    assert writer.rejected == 2
+    assert len(writer.batch) == 1
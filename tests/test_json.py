@@ -0,0 +1,45 @@
+import math
+from datetime import datetime
+import numpy as np
+import pytest
+from bson import ObjectId
+from flask import Flask
+from traderev.utils import JSONProvider
+
+@pytest.fixture(params=["orjson", "json"])
+def provider(request):
+    app = Flask(__name__)
+    app.config['JSON_BACKEND'] = request.param
+    return JSONProvider(app)
+
+def test_non_finite_values_become_null(provider):
+    obj = {
+        "float": math.nan,
+        "inf": [math.inf],
+        "numpy_float": np.float64("nan"),
+        "array": np.array([1.0, np.nan, np.inf]),
+    }
+    assert provider.loads(provider.dumps(obj)) == {
+        "float": None,
+        "inf": [None],
+        "numpy_float": None,
+        "array": [1.0, None, None],
+    }
+
+def test_bson_types(provider):
+    oid = ObjectId()
+    obj = {"_id": oid, "date": datetime(2023, 1, 2, 15, 4, 5), "count": np.int64(3)}
+    assert provider.loads(provider.dumps(obj)) == {
+        "_id": str(oid),
+        "date": "Mon, 02 Jan 2023 15:04:05 GMT",
+        "count": 3,
+    }
+
+def test_backends_agree():
+    payload = [{"n": np.float32(1.5), "v": np.array([2, 3]), "ok": np.bool_(True)}]
+    dumped = []
+    for backend in ("orjson", "json"):
+        app = Flask(__name__)
+        app.config['JSON_BACKEND'] = backend
+        dumped.append(JSONProvider(app).loads(JSONProvider(app).dumps(payload)))
+    assert dumped[0] == dumped[1]
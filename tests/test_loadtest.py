@@ -0,0 +1,42 @@
+from datetime import datetime
+import pytest
+from traderev import loadtest
+
+def test_seeded_transactions_use_dates():
+    transactions = list(loadtest.synthetic_transactions(10, 3, datetime(2023, 1, 2)))
+    assert transactions
+    assert all(isinstance(tr['transactiondate'], datetime) for tr in transactions)
+    assert len({tr['id'] for tr in transactions}) == len(transactions)
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile([], 50) is None
+
+def test_summarize_counts_errors_and_not_found():
+    results = [("trades", 0.010, 200), ("trades", 0.020, 404),
+               ("stats daily", 0.030, 500), ("stats daily", 0.040, None)]
+    summary = loadtest.summarize(results, 2.0)
+    assert summary["all"]["requests"] == 4
+    assert summary["all"]["errors"] == 2
+    assert summary["all"]["not_found"] == 1
+    assert summary["all"]["rps"] == 2.0
+    assert summary["trades"]["p99_ms"] == 20.0
+
+def scenario_requests(mix):
+    rng = loadtest.random.Random(0)
+    paths = loadtest.scenario_paths(mix, datetime(2023, 1, 2), 30, rng)
+    return [next(paths) for _ in range(200)]
+
+def test_scenarios_hit_wsgi_routes(app):
+    urls = app.url_map.bind("localhost")
+    for mix in loadtest.scenarios.values():
+        for _, method, path in scenario_requests(mix):
+            urls.match(path.split("?")[0], method=method)
+
+def test_dashboard_scenario_hits_asgi_routes(mongo_ini):
+    async_api = pytest.importorskip("traderev.async_api")
+    urls = async_api.create_asgi_app().url_map.bind("localhost")
+    for _, method, path in scenario_requests(loadtest.dashboard_scenario):
+        urls.match(path.split("?")[0], method=method)
@@ -0,0 +1,14 @@
+from traderev import pipeline
+from traderev.schemas import LogEntryType
+
+def test_concurrent_run_in_the_same_process_is_refused(app, database, monkeypatch):
+    concurrent = []
+    def stage(since):
+        # another request served by the same worker while the lock is held
+        concurrent.append(pipeline.run_pipeline())
+        return {"scanned": 0}
+    monkeypatch.setattr(pipeline, "stages", [("trades", LogEntryType.Trades, stage)])
+    with app.app_context():
+        assert pipeline.run_pipeline() == {"trades": {"scanned": 0}}
+    assert concurrent == [None]
+    assert database.locks.count_documents({}) == 0
@@ -0,0 +1,104 @@
+import inspect
+import os
+import re
+import pytest
+from pymongo import MongoClient, monitoring
+from pymongo.read_preferences import Primary, Secondary, SecondaryPreferred
+from traderev import create_app
+from traderev import db as traderev_db
+
+def write_ini(path, read_preference):
+    path.write_text("[default]\nmongo_uri=mongodb://localhost/traderev\n"
+                    f"[read_preference]\n{read_preference}\n")
+
+@pytest.mark.parametrize("mode", sorted(traderev_db.read_preference_modes))
+def test_make_read_preference(mode):
+    pref = traderev_db.make_read_preference(mode, 120)
+    assert isinstance(pref, traderev_db.read_preference_modes[mode])
+    assert pref.max_staleness == (-1 if mode == "primary" else 120)
+
+def test_make_read_preference_rejects_unknown_mode():
+    with pytest.raises(ValueError):
+        traderev_db.make_read_preference("secondaryOnly")
+
+def test_routed_reads_match_db_for_calls():
+    source = inspect.getsource(traderev_db)
+    called = set(re.findall(r'db_for\("(\w+)"\)', source))
+    called.update(re.findall(r'_basic_stats\("(\w+)"', source))
+    assert called == set(traderev_db.routed_reads)
+    assert all(callable(getattr(traderev_db, name)) for name in called)
+
+def test_config_is_parsed(mongo_ini, database):
+    write_ini(mongo_ini, "analytics=secondaryPreferred\nmax_staleness_seconds=120\n"
+                         "get_stats_by_trades=primary")
+    app = create_app({"TESTING": True})
+    assert app.config['MONGO_READ_PREFERENCES'] == {
+        "analytics": "secondaryPreferred", "get_stats_by_trades": "primary"}
+    assert app.config['MONGO_MAX_STALENESS_SECONDS'] == 120
+
+def test_no_section_reads_primary(app):
+    assert 'MONGO_READ_PREFERENCES' not in app.config
+
+@pytest.mark.parametrize("read_preference", [
+    "analytics=secondaryOnly",
+    "get_stats=secondary",
+    "analytics=secondary\nmax_staleness_seconds=30",
+])
+def test_invalid_config_fails_at_startup(mongo_ini, database, read_preference):
+    write_ini(mongo_ini, read_preference)
+    with pytest.raises(ValueError):
+        create_app({"TESTING": True})
+
+def test_db_for_routes_by_function_name(app, monkeypatch):
+    client = MongoClient("mongodb://localhost:1/traderev", connect=False)
+    monkeypatch.setattr(traderev_db, "db", client.traderev)
+    app.config['MONGO_READ_PREFERENCES'] = {"analytics": "secondaryPreferred",
+                                            "get_stats_by_trades": "primary",
+                                            "get_trades": "secondary"}
+    app.config['MONGO_MAX_STALENESS_SECONDS'] = 90
+    with app.app_context():
+        assert traderev_db.db_for("get_stats_by_trades").read_preference == Primary()
+        assert traderev_db.db_for("get_trades").read_preference == Secondary(max_staleness=90)
+        assert traderev_db.db_for("get_trades_toc").read_preference == \
+            SecondaryPreferred(max_staleness=90)
+
+class CommandRecorder(monitoring.CommandListener):
+
+    def __init__(self):
+        self.started = []
+
+    def started(self, event):
+        self.started.append(event)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+@pytest.mark.replset
+def test_routed_reads_go_to_secondaries(app, monkeypatch):
+    """Needs the replica set of replset.sh, e.g.
+    REPLSET_URI=mongodb://localhost:27017,localhost:27018,localhost:27019/traderev_test?replicaSet=rs0
+    """
+    uri = os.environ.get("REPLSET_URI")
+    if not uri:
+        pytest.skip("REPLSET_URI is not set")
+    recorder = CommandRecorder()
+    client = MongoClient(uri, event_listeners=[recorder])
+    database = client.get_default_database()
+    monkeypatch.setattr(traderev_db, "db", database)
+    app.config['MONGO_READ_PREFERENCES'] = {"analytics": "secondary"}
+    try:
+        database.trades.insert_one({"symbol": "SPY", "closingdate": 0})
+        with app.app_context():
+            list(traderev_db.get_trades())
+            traderev_db.get_open_trade_for_symbol("SPY")
+        commands = {e.command_name: e for e in recorder.started}
+        routed = commands["aggregate"]
+        assert routed.command["$readPreference"]["mode"] == "secondary"
+        assert routed.connection_id in client.secondaries
+        assert commands["find"].connection_id == client.primary
+    finally:
+        client.drop_database(database.name)
+        client.close()
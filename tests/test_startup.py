@@ -0,0 +1,18 @@
+import os
+from traderev import startup
+
+# Generous for slow CI machines, a cold create_app() takes a few hundred ms.
+max_ms = float(os.environ.get("STARTUP_MAX_MS", 2000))
+
+def test_cold_create_app(mongo_ini):
+    elapsed_ms, _, _, loaded = startup.startup_profile()
+    assert loaded == []
+    assert elapsed_ms < max_ms
+
+def test_parse_importtime():
+    output = "\n".join([
+        "import time: self [us] | cumulative | imported package",
+        "import time:       120 |        120 |   _io",
+        "import time:      2500 |       4100 | traderev",
+    ])
+    assert startup.parse_importtime(output) == [("  _io", 120, 120), ("traderev", 2500, 4100)]
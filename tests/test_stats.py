@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+import pytest
+
+def trade(symbol, putcall, closed, profit, cost=-100.0):
+    return {
+        "symbol": symbol,
+        "underlying": symbol.split("_")[0],
+        "putcall": putcall,
+        "openingdate": closed - timedelta(hours=3),
+        "closingdate": closed,
+        "openingprice": cost,
+        "closingprice": profit - cost,
+        "profitdollars": profit,
+        "profitpercent": profit / abs(cost),
+        "totalcommission": 1.3,
+        "totalfees": 0.05,
+        "openamount": 0,
+        "openingtransactions": [],
+        "closingtransactions": [],
+    }
+
+@pytest.fixture
+def trades(database):
+    # week of 2023-01-02 has wins and losses, week of 2023-01-09 only wins
+    week = datetime(2023, 1, 2, 15)
+    database.trades.insert_many([
+        trade("SPY_1", "PUT", week, 120.0),
+        trade("SPY_2", "CALL", week + timedelta(days=1), -80.0),
+        trade("QQQ_1", "PUT", week + timedelta(days=2), 45.5, cost=-250.0),
+        trade("QQQ_2", "CALL", week + timedelta(days=3), -210.0, cost=-300.0),
+        trade("IWM_1", "PUT", week + timedelta(days=4), 0.0),
+        trade("SPY_3", "PUT", week + timedelta(days=7), 60.0),
+        trade("IWM_2", "CALL", week + timedelta(days=8), 15.25, cost=-50.0),
+    ])
+
+def assert_same_stats(client, url):
+    """Both engines return the same fields with the same values.
+    """
+    by_pandas = client.get(url)
+    by_mongo = client.get(url + "&engine=mongo")
+    assert by_pandas.status_code == by_mongo.status_code == 200
+    by_pandas, by_mongo = by_pandas.get_json(), by_mongo.get_json()
+    assert by_pandas.keys() == by_mongo.keys()
+    for field, value in by_pandas.items():
+        if value is None:
+            assert by_mongo[field] is None, field
+        else:
+            assert by_mongo[field] == pytest.approx(value), field
+
+@pytest.mark.parametrize("n", [None, 3])
+def test_stats_by_trades_engines_agree(client, trades, n):
+    assert_same_stats(client, f"/api/stats/trades?n={n}" if n else "/api/stats/trades?")
+
+@pytest.mark.parametrize("week", ["2023-01-02", "2023-01-11"])
+def test_weekly_stats_engines_agree(client, trades, week):
+    assert_same_stats(client, f"/api/stats/weekly?week={week}")
+
+def test_no_losses_reports_null_profit_factor(client, trades):
+    res = client.get("/api/stats/weekly?week=2023-01-09&engine=mongo").get_json()
+    assert res["profit_factor"] is None
+    assert res["max_loss_dollars"] == 0
+
+def test_unknown_engine_is_rejected(client, trades):
+    assert client.get("/api/stats/trades?engine=spark").status_code == 400
+
+@pytest.mark.parametrize("url", [
+    "/api/trades?n=0",
+    "/api/trades?n=-1",
+    "/api/stats/trades?n=-1",
+    "/api/stats/trades?n=0&engine=mongo",
+    "/api/dashboard?week=2023-01-02&n=0",
+])
+def test_non_positive_limits_are_rejected(client, trades, url):
+    assert client.get(url).status_code == 400
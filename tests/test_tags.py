@@ -0,0 +1,46 @@
+import pytest
+
+def bulk(client, tags, entities, method="post"):
+    return getattr(client, method)("/api/tags/bulk", json={"tags": tags, "entities": entities})
+
+@pytest.mark.parametrize("tags, entities", [
+    ("fomo", [{"parent_type": "trade", "parent_id": "abc"}]),
+    ([], [{"parent_type": "trade", "parent_id": "abc"}]),
+    (["fomo", 1], [{"parent_type": "trade", "parent_id": "abc"}]),
+    (["fomo"], []),
+    (["fomo"], [{"parent_type": "portfolio", "parent_id": "abc"}]),
+    (["fomo"], [{"parent_type": "transaction", "parent_id": "12a"}]),
+    (["fomo"], [{"parent_type": "week", "parent_id": "not a date"}]),
+    (["fomo"], [{"parent_type": "week", "parent_id": "2023-01-04"}]),
+    (["fomo"], [{"parent_type": "week", "parent_id": 20230102}]),
+    (["fomo"], [{"parent_type": "day", "parent_id": "garbage"}]),
+    (["fomo"], [{"parent_type": "day", "parent_id": "2023-02-30"}]),
+    ([""], [{"parent_type": "day", "parent_id": "2023-01-04"}]),
+    (["  "], [{"parent_type": "day", "parent_id": "2023-01-04"}]),
+])
+def test_invalid_bulk_tag_requests(client, tags, entities):
+    assert bulk(client, tags, entities).status_code == 400
+    assert bulk(client, tags, entities, "delete").status_code == 400
+
+def test_bulk_tagged_transaction_found_by_id(client):
+    entities = [{"parent_type": "transaction", "parent_id": "123"},
+                {"parent_type": "week", "parent_id": "2023-01-02"}]
+    assert bulk(client, ["fomo"], entities).status_code == 200
+    res = client.get("/api/annotations/transaction/123").get_json()
+    assert res["tags"] == ["fomo"]
+    assert client.get("/api/weeks/2023-01-02").get_json()["tags"] == ["fomo"]
+    tagged = client.get("/api/tags/fomo").get_json()
+    assert {"parent_type": "transaction", "parent_id": 123} in tagged
+
+def test_annotation_indexes_are_created_once(client, database, monkeypatch):
+    calls = []
+    create_index = database.annotations.create_index
+    monkeypatch.setattr(type(database.annotations), "create_index",
+                        lambda self, *args, **kwargs: calls.append(args) or create_index(*args, **kwargs))
+    assert client.get("/api/tags/fomo").get_json() == []
+    assert len(calls) == 4
+    entities = [{"parent_type": "day", "parent_id": "2023-01-04"}]
+    for _ in range(3):
+        assert bulk(client, ["fomo"], entities).status_code == 200
+    assert len(calls) == 4
+    assert "tags_1_parent_type_1" in database.annotations.index_information()
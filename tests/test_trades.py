@@ -0,0 +1,100 @@
+from datetime import datetime
+from traderev import db as traderev_db, trades
+
+fees = {"optregfee": 0.02, "regfee": 0.0, "additionalfee": 0.0,
+        "cdscfee": 0.0, "othercharges": 0.0, "rfee": 0.0, "secfee": 0.01}
+
+def transaction(id, effect, cost, amount, day):
+    return {"id": id, "symbol": "SPY_011523P390", "underlying": "SPY", "putcall": "PUT",
+            "positioneffect": effect, "cost": cost, "amount": amount,
+            "commission": 0.65 * amount, "transactiondate": datetime(2023, 1, day, 15),
+            **fees}
+
+def seed(database):
+    database.transactions.insert_many([
+        transaction(1, "OPENING", -300.0, 2.0, 3),
+        transaction(2, "CLOSING", 150.0, 1.0, 4),
+        transaction(3, "CLOSING", 120.0, 1.0, 5),
+    ])
+
+def trade_state(database):
+    return [(t["openamount"], t["closingprice"], len(t["closingtransactions"]))
+            for t in database.trades.find({}, {"_id": 0})]
+
+def test_rebuild_twice_changes_nothing(client, database):
+    seed(database)
+    assert client.post("/api/trades").status_code == 200
+    assert trade_state(database) == [(0.0, 270.0, 2)]
+    assert client.post("/api/trades").status_code == 200
+    assert trade_state(database) == [(0.0, 270.0, 2)]
+
+def test_rerun_after_partly_applied_plan(client, app, database):
+    seed(database)
+    with app.app_context():
+        plan = trades.plan_trades()
+        # the insert and first close were written before a failure
+        plan["close"] = plan["close"][:1]
+        trades.apply_plan(plan)
+    assert trade_state(database) == [(1.0, 150.0, 1)]
+    assert client.post("/api/trades").status_code == 200
+    assert client.post("/api/trades").status_code == 200
+    assert trade_state(database) == [(0.0, 270.0, 2)]
+
+def test_closing_update_applies_once(app, database):
+    seed(database)
+    with app.app_context():
+        trades.apply_plan(trades.plan_trades())
+        trade = database.trades.find_one()
+        tr = database.transactions.find_one({"id": 2})
+        match, update = traderev_db.close_trade_update(traderev_db.trade_key(trade), tr)
+        assert database.trades.update_one(match, update).modified_count == 0
+    assert trade_state(database) == [(0.0, 270.0, 2)]
+
+def test_dry_run_writes_nothing(client, database):
+    seed(database)
+    transactions = list(database.transactions.find())
+    res = client.post("/api/trades?dry_run=true")
+    assert res.get_json() == {"insert": 1, "close": 2, "unsettle": 0, "unmatched": 0,
+                              "tracked": 0}
+    assert database.trades.count_documents({}) == 0
+    assert database.utilitylog.count_documents({}) == 0
+    assert list(database.transactions.find()) == transactions
+
+def settle(app, today):
+    with app.app_context():
+        return trades.settle_expired_trades(today)
+
+def test_settlement_waits_for_the_grace_period(client, app, database):
+    # SPY_011523P390 expires on 2023-01-15
+    database.transactions.insert_one(transaction(1, "OPENING", -300.0, 2.0, 3))
+    client.post("/api/trades")
+    assert settle(app, datetime(2023, 1, 18)) == (1, 0)
+    assert settle(app, datetime(2023, 1, 19)) == (1, 1)
+    trade = database.trades.find_one()
+    assert trade["expired"] and trade["openamount"] == 0
+    assert trade["closingdate"] == datetime(2023, 1, 15, 20)
+
+def test_late_closing_transaction_replaces_the_settlement(client, app, database):
+    database.transactions.insert_one(transaction(1, "OPENING", -300.0, 2.0, 3))
+    client.post("/api/trades")
+    settle(app, datetime(2023, 1, 19))
+    # the assignment is imported after the settlement
+    database.transactions.insert_one(transaction(2, "CLOSING", 500.0, 2.0, 16))
+    for _ in range(2):
+        assert client.post("/api/trades").status_code == 200
+        trade = database.trades.find_one()
+        assert "expired" not in trade
+        assert trade_state(database) == [(0.0, 500.0, 1)]
+        assert trade["closingdate"] == datetime(2023, 1, 16, 15)
+
+def test_partial_late_close_is_settled_again(client, app, database):
+    database.transactions.insert_one(transaction(1, "OPENING", -300.0, 2.0, 3))
+    client.post("/api/trades")
+    settle(app, datetime(2023, 1, 19))
+    database.transactions.insert_many([transaction(2, "CLOSING", 200.0, 1.0, 16)])
+    client.post("/api/trades")
+    assert trade_state(database) == [(1.0, 200.0, 1)]
+    assert "expired" not in database.trades.find_one()
+    assert settle(app, datetime(2023, 1, 19)) == (1, 1)
+    assert trade_state(database) == [(0.0, 200.0, 1)]
+    assert database.trades.find_one()["expired"]
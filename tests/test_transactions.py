@@ -0,0 +1,37 @@
+import pytest
+from traderev import db as traderev_db
+
+def test_batch_lookup_ensures_id_index_once(client, database, monkeypatch):
+    database.transactions.insert_many([{"id": 1, "symbol": "SPY"}, {"id": 2, "symbol": "QQQ"}])
+    calls = []
+    ensure = traderev_db.ensure_transaction_indexes
+    def counting_ensure():
+        calls.append(1)
+        ensure()
+    counting_ensure.__name__ = ensure.__name__
+    monkeypatch.setattr(traderev_db, "ensure_transaction_indexes", counting_ensure)
+
+    for _ in range(3):
+        res = client.post("/api/transactions/batch", json={"ids": [1, 2, 3]})
+        assert res.status_code == 200
+    assert res.get_json()["missing"] == [3]
+    assert len(calls) == 1
+    index = [i for i in database.transactions.index_information().values()
+             if i["key"] == [("id", 1)]]
+    assert index and index[0]["unique"]
+
+@pytest.mark.parametrize("ids", [["1"], [True], [1.5], {"1": 1}])
+def test_batch_lookup_rejects_bad_ids(client, ids):
+    assert client.post("/api/transactions/batch", json={"ids": ids}).status_code == 400
+
+def test_open_trade_indexes_are_partial(app, database):
+    with app.app_context():
+        traderev_db.ensure_trade_indexes()
+    indexes = database.trades.index_information()
+    keys = {name: indexes[name]["key"] for name in
+            ("open_by_date", "open_by_symbol", "open_by_underlying")}
+    assert keys == {"open_by_date": [("openingdate", 1)],
+                    "open_by_symbol": [("symbol", 1), ("openingdate", 1)],
+                    "open_by_underlying": [("underlying", 1), ("openingdate", 1)]}
+    for name in keys:
+        assert indexes[name]["partialFilterExpression"] == {"openamount": {"$gt": 0}}
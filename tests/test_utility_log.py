@@ -0,0 +1,40 @@
+from pymongo.errors import OperationFailure
+from traderev import db as traderev_db
+from traderev.schemas import LogEntryType, UtilityLogEntry
+
+def entry():
+    return UtilityLogEntry(logtype=LogEntryType.Trades, message=["Inserted 1 new trades"],
+                           inserted=1, elapsed=0.5)
+
+def test_indexes_are_created_once(app, database, monkeypatch):
+    calls = []
+    create_index = database.utilitylog.create_index
+    monkeypatch.setattr(type(database.utilitylog), "create_index",
+                        lambda self, *args, **kwargs: calls.append(args) or create_index(*args, **kwargs))
+    with app.app_context():
+        for _ in range(3):
+            traderev_db.add_utility_event(entry())
+    assert database.utilitylog.count_documents({}) == 3
+    assert len(calls) == 2
+    ttl = database.utilitylog.index_information()["timestamp_1"]
+    assert ttl["expireAfterSeconds"] == 365 * 24 * 60 * 60
+
+def test_changed_ttl_uses_collmod(app, database, monkeypatch):
+    database.utilitylog.create_index("timestamp", expireAfterSeconds=60)
+    commands = []
+    monkeypatch.setattr(type(database), "command",
+                        lambda self, *args, **kwargs: commands.append((args, kwargs)))
+    app.config['UTILITY_LOG_TTL_DAYS'] = 30
+    with app.app_context():
+        traderev_db.ensure_utility_log_indexes()
+    assert commands == [(("collMod", "utilitylog"), {
+        "index": {"keyPattern": {"timestamp": 1}, "expireAfterSeconds": 30 * 24 * 60 * 60}})]
+
+def test_index_failure_keeps_the_entry(app, database, monkeypatch):
+    def fail():
+        raise OperationFailure("IndexOptionsConflict")
+    fail.__name__ = "ensure_utility_log_indexes"
+    monkeypatch.setattr(traderev_db, "ensure_utility_log_indexes", fail)
+    with app.app_context():
+        traderev_db.add_utility_event(entry())
+    assert database.utilitylog.count_documents({}) == 1
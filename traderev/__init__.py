@@ -1,15 +1,19 @@
 import os
 import sys
 import configparser
-from flask import Flask, redirect
+from flask import Flask
 from flask_cors import CORS
-from werkzeug.middleware.profiler import ProfilerMiddleware
-from .utils import CustomJSONEncoder
+from .utils import JSONProvider
 
 mongo_config_fmt = """[default]
 mongo_uri=<url>
 db_name=traderev
 transactions_col=transactions
+
+; optional, read preference of stats, export and list reads
+[read_preference]
+analytics=secondaryPreferred
+max_staleness_seconds=90
 """
 
 def create_app(test_config=None):
@@ -24,27 +28,35 @@ def create_app(test_config=None):
     else:
         app.config.from_pyfile('config.py', silent=True)
 
-    profiles_path = os.path.join(app.instance_path, 'profiles')
     try:
         os.makedirs(app.instance_path)
     except OSError as e:
         pass
 
-    try:
-        os.makedirs(profiles_path)
-    except OSError as e:
-        pass
-
     from . import api
+    from . import compression
     from . import frontend
     app.register_blueprint(api.bp)
     app.register_blueprint(frontend.bp)
+    compression.init_app(app)
     cors = CORS(app, resources={r"/api/*": {'origins':r"*"}})
     # @app.errorhandler(404)
     # def not_found_redirect(e):
     #     return redirect('/', 302)
-    # app.wsgi_app = ProfilerMiddleware(app.wsgi_app, profile_dir=profiles_path)
+    if app.config.get('PROFILE'):
+        from werkzeug.middleware.profiler import ProfilerMiddleware
+        profiles_path = os.path.join(app.instance_path, 'profiles')
+        os.makedirs(profiles_path, exist_ok=True)
+        app.wsgi_app = ProfilerMiddleware(app.wsgi_app, profile_dir=profiles_path)
+
+    app.json = JSONProvider(app)
+    load_mongo_config(app)
+    return app
 
+def load_mongo_config(app):
+    """Read the mongo settings from the file named by MONGO_INI into the app
+    config.
+    """
     config_file = os.environ.get('MONGO_INI', None)
     if not config_file:
         print("MONGO_INI environment variable needs to be set to a mongo config file.")
@@ -52,8 +64,13 @@ def create_app(test_config=None):
         print(mongo_config_fmt)
         sys.exit(1)
 
-    app.json_encoder = CustomJSONEncoder
     config = configparser.ConfigParser()
     config.read(config_file)
     app.config['MONGO_URI'] = config['default']['mongo_uri']
-    return app
\ No newline at end of file
+    if config.has_section('read_preference'):
+        from .db import validate_read_preferences
+        preferences = dict(config['read_preference'])
+        max_staleness = int(preferences.pop('max_staleness_seconds', -1))
+        validate_read_preferences(preferences, max_staleness)
+        app.config['MONGO_MAX_STALENESS_SECONDS'] = max_staleness
+        app.config['MONGO_READ_PREFERENCES'] = preferences
\ No newline at end of file
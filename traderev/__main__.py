@@ -1,5 +1,59 @@
 __package__ = 'traderev'
+import argparse
+import sys
 from traderev import create_app
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="traderev")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="Run the development server (default).")
+    profile = commands.add_parser("startup-profile",
+                                  help="Report import and create_app() time of a cold start.")
+    profile.add_argument("--top", type=int, default=15,
+                         help="Number of slowest modules to list.")
+    profile.add_argument("--max-ms", type=float, default=None,
+                         help="Exit with an error if create_app() takes longer.")
+    load = commands.add_parser("loadtest",
+                               help="Capacity report of gunicorn worker classes and counts.")
+    load.add_argument("--mongo-uri", default=None,
+                      help="Database to seed and serve, it is dropped first.")
+    load.add_argument("--worker-class", nargs="+", default=["gevent", "sync"],
+                      help="Gunicorn worker classes to compare, 'asgi' runs asgi:app with hypercorn.")
+    load.add_argument("--scenario", choices=["full", "dashboard"], default="full",
+                      help="Request mix, 'dashboard' only uses endpoints the ASGI app serves.")
+    load.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4],
+                      help="Worker counts to compare.")
+    load.add_argument("--users", type=int, default=20,
+                      help="Concurrent virtual users.")
+    load.add_argument("--duration", type=float, default=30,
+                      help="Seconds of load per run.")
+    load.add_argument("--warmup", type=float, default=5,
+                      help="Seconds of unmeasured load before each run.")
+    load.add_argument("--days", type=int, default=365,
+                      help="Days of synthetic transactions to seed.")
+    load.add_argument("--per-day", type=int, default=10,
+                      help="Positions opened per seeded trading day.")
+    load.add_argument("--by-endpoint", action="store_true",
+                      help="Report every endpoint of the mix, not only the totals.")
+    scheduler = commands.add_parser("scheduler",
+                                    help="Run the batch job pipeline on a schedule.")
+    scheduler.add_argument("--schedule", default=None,
+                           help="Cron expression, defaults to PIPELINE_SCHEDULE or every 15 minutes.")
+    scheduler.add_argument("--once", action="store_true",
+                           help="Run the pipeline once and exit.")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "startup-profile":
+        from traderev import startup
+        sys.exit(startup.main(args))
+    if args.command == "scheduler":
+        from traderev import scheduler
+        sys.exit(scheduler.main(args))
+    if args.command == "loadtest":
+        from traderev import loadtest
+        args.mongo_uri = args.mongo_uri or loadtest.default_mongo_uri
+        sys.exit(loadtest.main(args))
     app = create_app()
-    app.run(host='0.0.0.0')
\ No newline at end of file
+    app.run(host='0.0.0.0')
@@ -0,0 +1,125 @@
+"""Trade analytics built on pandas.
+
+pandas is slow to import, so this module is only imported by the code paths
+computing statistics, keeping worker boot time low.
+"""
+import numpy as np
+import pandas as pd
+from typing import Dict, List
+
+def compute_basic_stats(df: pd.DataFrame):
+    """Computes basic trade statistics from a pandas dataframe.
+
+    Parameters
+    ----------
+        df : pd.DataFrame
+
+    Returns
+    -------
+        dict: A dictionary with statistics data
+    """
+    stats = {}
+    stats['total_trades'] = df.shape[0]
+    stats['gross_pnl'] = df['profitdollars'].sum()
+    stats['call_count'] = len(df[df['putcall'] == 'CALL'])
+    stats['put_count'] = len(df[df['putcall'] == 'PUT'])
+    stats['total_commission'] = df['totalcommission'].sum()
+    stats['total_fees'] = df['totalfees'].sum()
+
+    stats['max_gain_dollars'] = df['profitdollars'].max()
+    stats['max_gain_percent'] = df['profitpercent'].max()
+    stats['max_loss_dollars'] = 0
+    stats['max_loss_percent'] = 0
+    stats['avg_loss_percent'] = 0
+    stats['avg_loss_dollars'] = 0
+    stats['avg_gain_dollars'] = 0
+    stats['avg_gain_percent'] = 0
+
+    any_wins = df['profitdollars'] > 0
+    winning_trades = df[any_wins]
+    stats['win_rate'] = len(winning_trades) / df.shape[0] * 100
+    gross_profit = winning_trades['profitdollars'].sum()
+    if any(any_wins):
+        stats['avg_gain_dollars'] = winning_trades['profitdollars'].mean()
+        stats['avg_gain_percent'] = winning_trades['profitpercent'].mean()
+
+    any_loses = df['profitdollars'] < 0
+    losing_trades = df[any_loses]
+    gross_loss = losing_trades['profitdollars'].sum()
+    if any(any_loses):
+        stats['max_loss_dollars'] = losing_trades['profitdollars'].min()
+        stats['max_loss_percent'] = losing_trades['profitpercent'].min()
+        stats['avg_loss_dollars'] = losing_trades['profitdollars'].mean()
+        stats['avg_loss_percent'] = losing_trades['profitpercent'].mean()
+
+    stats['profit_factor'] = gross_profit / gross_loss
+    stats['total_pnl'] = stats['gross_pnl'] - stats['total_commission'] - stats['total_fees']
+    return stats
+
+def compute_equity_curve(pnl: pd.Series, start_pnl: float = 0, start_peak: float = 0):
+    """Computes the cumulative P&L and drawdown of a series of trade profits.
+
+    The start values allow extending a previously computed curve with newly
+    closed trades.
+
+    Parameters
+    ----------
+        pnl : pd.Series Profit of each trade, in closing order.
+        start_pnl : float Cumulative P&L preceding the first trade.
+        start_peak : float Equity peak preceding the first trade.
+
+    Returns
+    -------
+        pd.DataFrame: With cumulative_pnl, peak and drawdown columns.
+    """
+    cumulative = pnl.cumsum() + start_pnl
+    peak = cumulative.cummax().clip(lower=start_peak)
+    return pd.DataFrame({
+        'cumulative_pnl': cumulative,
+        'peak': peak,
+        'drawdown': cumulative - peak,
+    })
+
+def compute_rolling_stats(pnl: pd.Series, window: int):
+    """Computes win rate and profit factor over a rolling window of trades.
+
+    Profit factor follows compute_basic_stats, gross profit over gross loss.
+    The first window - 1 rows are NaN.
+
+    Parameters
+    ----------
+        pnl : pd.Series Profit of each trade, in closing order.
+        window : int Number of trades in the window.
+
+    Returns
+    -------
+        pd.DataFrame: With win_rate and profit_factor columns.
+    """
+    win_rate = (pnl > 0).astype(float).rolling(window).mean() * 100
+    gross_profit = pnl.clip(lower=0).rolling(window).sum()
+    gross_loss = pnl.clip(upper=0).rolling(window).sum()
+    return pd.DataFrame({
+        'win_rate': win_rate,
+        'profit_factor': gross_profit / gross_loss,
+    })
+
+def downsample(df: pd.DataFrame, points: int = None) -> pd.DataFrame:
+    """Select at most `points` evenly spaced rows, keeping the first and last.
+    """
+    if not points or len(df) <= points:
+        return df
+    idx = np.unique(np.linspace(0, len(df) - 1, points).round().astype(int))
+    return df.iloc[idx]
+
+def frame_to_records(df: pd.DataFrame) -> List[Dict]:
+    """Convert a dataframe into a list of JSON serializeable dictionaries.
+
+    NaN and infinite values become None.
+    """
+    df = df.replace([np.inf, -np.inf], np.nan).astype(object)
+    return df.where(df.notna(), None).to_dict('records')
+
+def trades_frame(trades) -> pd.DataFrame:
+    """Build a dataframe from trade documents.
+    """
+    return pd.DataFrame(trades)
@@ -1,15 +1,17 @@
 import time
-import pandas as pd
 from datetime import datetime, timedelta
 from flask import abort, Blueprint, current_app as app, make_response, request
-from traderev import db
-from traderev.utils import (compute_basic_stats,
-        date_fmt,
-        flatten_dict,
+from traderev import db, trades
+from traderev.compression import cached_response
+from traderev.ingest import ingest
+from traderev.utils import (date_fmt,
         week_range,
         weeks_of_year,
         )
-from traderev.schemas import LogEntryType, UtilityLogEntry, TradingWeek
+from traderev.schemas import LogEntryType, Memo, UtilityLogEntry, TradingWeek
+
+# traderev.analytics and traderev.equity pull in pandas, they are imported
+# inside the stats views so workers only pay for it once stats are requested.
 
 bp = Blueprint("api", __name__, url_prefix="/api")
 @bp.route("/transactions", methods=["GET"])
@@ -29,6 +31,25 @@ def transaction_by_id(trans_id):
         abort(404)
     return res
 
+@bp.route("/transactions/batch", methods=["POST"])
+def transactions_by_ids():
+    """Returns the transactions for a list of IDs in a single query.
+
+    Expects {"ids": [...]} with at most TRANSACTIONS_BATCH_LIMIT ids.
+    """
+    body = request.get_json(silent=True) or {}
+    ids = body.get('ids')
+    if not isinstance(ids, list) or not all(type(i) is int for i in ids):
+        abort(400)
+    if len(ids) > app.config.get('TRANSACTIONS_BATCH_LIMIT', 5000):
+        abort(413)
+    res = db.get_transactions_by_ids(ids)
+    found = {tr['id'] for tr in res}
+    return {
+        'transactions': res,
+        'missing': [i for i in ids if i not in found],
+    }
+
 @bp.route("/transactions/daily", methods=["GET"])
 def transaction_by_date():
     """List transactions by date.
@@ -54,6 +75,9 @@ def get_trades():
         pass
     except ValueError:
         abort(400)
+    # MongoDB rejects a $limit below 1
+    if num is not None and num < 1:
+        abort(400)
     res = db.get_trades(num)
     if not res:
         abort(404)
@@ -62,12 +86,29 @@ def get_trades():
 @bp.route("/trades/<string:trade_id>", methods=["GET"])
 def get_trade_by_id(trade_id):
     """Return trade by ID.
+
+    With `expand=transactions` the referenced transactions are embedded.
     """
-    res = db.get_trade_by_id(trade_id)
+    if request.args.get('expand') == 'transactions':
+        res = db.get_trade_with_transactions(trade_id)
+    else:
+        res = db.get_trade_by_id(trade_id)
     if not res:
         abort(404)
     return res 
 
+@bp.route("/positions/open", methods=["GET"])
+def get_open_positions():
+    """Return the open trades, oldest first.
+
+    Filtered by `symbol` or `underlying` when given.
+    """
+    res = db.get_open_positions(request.args.get('symbol'),
+                                request.args.get('underlying'))
+    if not res:
+        abort(404)
+    return res
+
 @bp.route("/trades/daily", methods=["GET"])
 def trades_by_date():
     """List trades by specified date.
@@ -96,10 +137,8 @@ def update_trades_v2():
         3. Close when encountering a closing transaction for the same symbol.
     """
     start_time = time.time()
-    # Can't think of another place to do this
-    db.db.trades.create_index("symbol", background=True)
-    db.db.trades.create_index("openingdate", background=True)
-    db.db.trades.create_index("closingdate", background=True)
+    db.ensure_trade_indexes()
+    db.ensure_transaction_indexes()
     if request.data:
         try:
             page_size = request.get_json()['page_size']
@@ -118,28 +157,7 @@ def update_trades_v2():
             # should always mark it as processed, nothing else could be done with it
             ids_to_mark.append(tr['id'])
             if tr['positioneffect'] == "OPENING":
-                totalfees = tr['optregfee'] + tr['regfee'] + tr['additionalfee'] + \
-                    tr['cdscfee'] + tr['othercharges'] + tr['rfee'] + tr['secfee']
-                trade_doc = {
-                    "symbol": tr['symbol'],
-                    "underlying": tr['underlying'],
-                    "putcall": tr['putcall'],
-                    "openingdate": tr['transactiondate'],
-                    "closingdate": 0,
-                    "openingprice": tr['cost'],
-                    "closingprice": 0,
-                    "profitdollars": 0,
-                    "profitpercent": 0,
-                    "totalcommission": tr['commission'],
-                    "totalfees": totalfees,
-                    "openingtransactions": [{
-                        "id": tr['id'],
-                        "amount": tr['amount']
-                    }],
-                    "closingtransactions": [],
-                    "openamount": tr['amount']
-                }
-                res = db.create_trade(trade_doc)
+                res = db.create_trade(trades.trade_doc_from_transaction(tr))
             elif tr['positioneffect'] == "CLOSING":
                 # find the matching open trade for it
                 trade = db.get_open_trade_for_symbol(tr['symbol'])
@@ -159,81 +177,44 @@ def update_trades_v2():
 @bp.route("/trades", methods=["POST"])
 def update_trades():
     """Update trades collection
+
+    The changes are computed as a plan against the current trades and
+    applied as idempotent updates, so the job can safely be rerun.
+    With `dry_run=true` only the counts of the plan are returned.
     """
     start_time = time.time()
-    # Can't think of another place to do this
-    db.db.trades.create_index("symbol", background=True)
-    db.db.trades.create_index("openingdate", background=True)
-    db.db.trades.create_index("closingdate", background=True)
-    opening_trans_trades = db.get_trades_opening_transaction_ids()
-    opening_ids = flatten_dict(opening_trans_trades, "id")
-    opening_trans = db.get_opening_transactions()
-    inserted_count = 0
-    for tr in opening_trans:
-        # TODO: Move this logic to db.py, add an agregation stage to filter these out.
-        if tr['id'] in opening_ids:
-            app.logger.debug("Transaction with ID (%s) already tracked in trades collection.", tr['id'])
-            continue
-        totalfees = tr['optregfee'] + tr['regfee'] + tr['additionalfee'] + \
-            tr['cdscfee'] + tr['othercharges'] + tr['rfee'] + tr['secfee']
-        trade_doc = {
-            "symbol": tr['symbol'],
-            "underlying": tr['underlying'],
-            "putcall": tr['putcall'],
-            "openingdate": tr['transactiondate'],
-            "closingdate": 0,
-            "openingprice": tr['cost'],
-            "closingprice": 0,
-            "profitdollars": 0,
-            "profitpercent": 0,
-            "totalcommission": tr['commission'],
-            "totalfees": totalfees,
-            "openingtransactions": [{
-                "id": tr['id'],
-                "amount": tr['amount']
-            }],
-            "closingtransactions": [],
-            "openamount": tr['amount']
-        }
-        res = db.create_trade(trade_doc)
-        if res:
-            inserted_count += 1
-            app.logger.debug("Inserted trade %s", res.inserted_id)
-
-    closing_trans_trades = db.get_trades_closing_transaction_ids()
-    closing_ids = flatten_dict(closing_trans_trades, "id")
-    all_closing_trans = db.get_closing_transactions()
-    updated_count = 0
-    for tr in all_closing_trans:
-        # TODO: Another way to do this is to select trades which are still in 'open' state
-        # and query for transactions which match the symbol of these trades.
-        if tr['id'] in closing_ids:
-            app.logger.debug("Transaction with ID (%s) already tracked in trades collection.", tr['id'])
-            continue
-        # ideally only a single trade is open per symbol, this works for options.
-        trade = db.get_open_trade_for_symbol(tr['symbol'])
-        if not trade:
-            app.logger.info("No open trade found for this closing transaction: %s", tr)
-            continue
-        # app.logger.debug("Found an open trade to close : %s", trade)
-        db.close_trade_with_transaction(trade['_id'], tr)
-        updated_count += 1
+    dry_run = request.args.get('dry_run', 'false').lower() in ('1', 'true', 'yes')
+    plan = trades.plan_trades()
+    for tr in plan["unmatched"]:
+        app.logger.info("No open trade found for this closing transaction: %s", tr['id'])
+    if dry_run:
+        return trades.plan_summary(plan)
+    db.ensure_trade_indexes()
+    db.ensure_transaction_indexes()
+    inserted_count, updated_count = trades.apply_plan(plan)
     elapsed_time = time.time() - start_time
     message = [
         f"Inserted {inserted_count} new trades",
         f"Updated {updated_count} trades",
         f"Elapsed {elapsed_time:.2f}s",
     ]
+    summary = trades.plan_summary(plan)
     event_entry = UtilityLogEntry(logtype=LogEntryType("Trades"),
                                   timestamp=datetime.utcnow(),
                                   author="/trades API",
-                                  message=message)
+                                  message=message,
+                                  scanned=sum(summary.values()),
+                                  inserted=inserted_count,
+                                  updated=updated_count,
+                                  elapsed=elapsed_time)
     db.add_utility_event(event_entry)
     return message
 
 @bp.route("/trades/profits", methods=["POST"])
 def update_trade_profits():
+    start_time = time.time()
     res = db.update_trades_profits()
+    elapsed_time = time.time() - start_time
     output = [
         f"Matched {res.matched_count} trades",
         f"Updated {res.modified_count} trades",
@@ -241,10 +222,24 @@ def update_trade_profits():
     event_entry = UtilityLogEntry(logtype=LogEntryType("Profits"),
                                   timestamp=datetime.utcnow(),
                                   author="/trades/profits API",
-                                  message=output)
+                                  message=output,
+                                  scanned=res.matched_count,
+                                  updated=res.modified_count,
+                                  elapsed=elapsed_time)
     db.add_utility_event(event_entry)
     return output
 
+def server_side_stats():
+    """Whether the request asked for stats to be computed by mongodb.
+
+    Selected with `?engine=mongo`, the default `pandas` engine pulls the
+    trade documents and computes the stats locally.
+    """
+    engine = request.args.get('engine', 'pandas')
+    if engine not in ('pandas', 'mongo'):
+        abort(400)
+    return engine == 'mongo'
+
 @bp.route("/stats/trades", methods=["GET"])
 def stats_by_trades():
     num = None
@@ -254,8 +249,17 @@ def stats_by_trades():
         pass
     except ValueError:
         abort(400)
+    # MongoDB rejects a $limit below 1
+    if num is not None and num < 1:
+        abort(400)
+    if server_side_stats():
+        res = db.get_stats_by_trades(num)
+        if not res:
+            abort(404)
+        return res
+    from traderev.analytics import compute_basic_stats, trades_frame
     res = db.get_trades(num) 
-    df = pd.DataFrame(res)
+    df = trades_frame(res)
     return compute_basic_stats(df)
 
 @bp.route("/stats/daily", methods=["GET"])
@@ -265,10 +269,16 @@ def daily_stats():
         day = datetime.strptime(day, date_fmt).date()
     except (ValueError, KeyError):
         abort(400)
+    if server_side_stats():
+        res = db.get_stats_by_date(day)
+        if not res:
+            abort(404)
+        return res
+    from traderev.analytics import compute_basic_stats, trades_frame
     trades = db.get_closed_trades_by_date(day)
     if not trades:
         abort(404)
-    df = pd.DataFrame(trades)
+    df = trades_frame(trades)
     return compute_basic_stats(df)
 
 @bp.route("/stats/weekly", methods=["GET"])
@@ -282,17 +292,184 @@ def weekly_stats():
     except ValueError:
         abort(400)
     app.logger.debug(f"Grabbing stats between {start_date} and {end_date}")
+    if server_side_stats():
+        res = db.get_stats_by_date_range(start_date, end_date)
+        if not res:
+            abort(404)
+        return res
+    from traderev.analytics import compute_basic_stats, trades_frame
     trades = db.get_closed_trades_by_date_range(start_date, end_date)
     if not len(trades):
         abort(404)
-    df = pd.DataFrame(trades)
+    df = trades_frame(trades)
     return compute_basic_stats(df)
 
+@bp.route("/stats/breakdown", methods=["GET"])
+def breakdown_stats():
+    """Stats for closed trades grouped by one or more dimensions.
+    """
+    try:
+        dimensions = request.args['by'].split(',')
+        start = request.args.get('from')
+        end = request.args.get('to')
+        start = start and datetime.strptime(start, date_fmt)
+        # include the whole ending day
+        end = end and datetime.strptime(end, date_fmt) + timedelta(days=1, microseconds=-1)
+        num = int(request.args.get('n', 0))
+    except (ValueError, KeyError):
+        abort(400)
+    sort = request.args.get('sort', 'total_trades')
+    if not dimensions or any(d not in db.stats_dimensions for d in dimensions):
+        abort(400)
+    if sort not in db.basic_stats_project['$project'] or sort == '_id':
+        abort(400)
+    if num < 0:
+        abort(400)
+    res = db.get_stats_breakdown(dimensions, start, end, sort, num)
+    if not res:
+        abort(404)
+    return res
+
+def requested_points():
+    """Parse the optional `points` argument used to downsample series.
+    """
+    try:
+        points = int(request.args.get('points', 0))
+    except ValueError:
+        abort(400)
+    if points < 0:
+        abort(400)
+    return points
+
+@bp.route("/stats/equity", methods=["GET"])
+def equity_stats():
+    """Cumulative P&L and drawdown over closed trades ordered by closing date.
+    """
+    from traderev.analytics import downsample, frame_to_records
+    from traderev.equity import trade_series
+    points = requested_points()
+    frame = trade_series.refresh()
+    if frame.empty:
+        abort(404)
+    series = downsample(frame, points)
+    return {
+        'total_trades': len(frame),
+        'total_pnl': frame['cumulative_pnl'].iloc[-1],
+        'max_drawdown': frame['drawdown'].min(),
+        'points': frame_to_records(
+            series[['closingdate', 'cumulative_pnl', 'drawdown']]),
+    }
+
+@bp.route("/stats/rolling", methods=["GET"])
+def rolling_stats():
+    """Rolling win rate and profit factor over the last `window` closed trades.
+    """
+    try:
+        window = int(request.args['window'])
+    except (ValueError, KeyError):
+        abort(400)
+    if window < 1:
+        abort(400)
+    from traderev.analytics import downsample, frame_to_records
+    from traderev.equity import trade_series
+    points = requested_points()
+    stats = trade_series.rolling(window).dropna(subset=['win_rate'])
+    if stats.empty:
+        abort(404)
+    stats = stats.join(trade_series.frame['closingdate'])
+    series = downsample(stats, points)
+    return {
+        'window': window,
+        'points': frame_to_records(
+            series[['closingdate', 'win_rate', 'profit_factor']]),
+    }
+
+@bp.route("/dashboard", methods=["GET"])
+def dashboard():
+    """Week tags, weekly and daily stats and recent trades in one response.
+
+    The queries run one after another, the ASGI app in async_api runs them
+    concurrently.
+    """
+    try:
+        start_date, end_date = week_range(request.args['week'])
+        num = int(request.args.get('n', 10))
+    except (ValueError, KeyError):
+        abort(400)
+    if num < 1:
+        abort(400)
+    week = TradingWeek(datetime.strftime(start_date, date_fmt))
+    tags = db.get_tags_for_week(week.start_date)
+    return {
+        'week': week.start_date,
+        'tags': (tags or {}).get('tags', []),
+        'weekly_stats': db.get_stats_by_date_range(start_date, end_date),
+        'daily_stats': {day: db.get_stats_by_date(day) for day in week.weekdays},
+        'recent_trades': list(db.get_trades(num)),
+    }
+
 @bp.route("/utils/datetoc", methods=["POST"])
 def make_date_toc():
     res = db.make_trades_toc()
     return make_response(list(res), 202)
 
+@bp.route("/utils/datetoc", methods=["GET"])
+@cached_response("trades_date_toc")
+def get_date_toc():
+    res = db.get_trades_toc()
+    return list(res)
+
+@bp.route("/utils/archive", methods=["POST"])
+def archive():
+    """Move processed transactions and closed trades older than a cutoff to
+    the archive collections.
+
+    The cutoff is either `before` (YYYY-MM-DD) in the JSON body, or
+    ARCHIVE_AFTER_DAYS days ago.
+    """
+    start_time = time.time()
+    body = request.get_json(silent=True) or {}
+    try:
+        if 'before' in body:
+            cutoff = datetime.strptime(body['before'], date_fmt)
+        else:
+            days = app.config.get('ARCHIVE_AFTER_DAYS', 90)
+            cutoff = datetime.utcnow() - timedelta(days=days)
+    except (ValueError, TypeError):
+        abort(400)
+    batch_size = app.config.get('ARCHIVE_BATCH_SIZE', 1000)
+    db.ensure_archive_collections()
+    # profits must be final before trades go to cold storage
+    db.update_trades_profits()
+    trades_count = db.archive_trades(cutoff, batch_size)
+    transactions_count = db.archive_transactions(cutoff, batch_size)
+    elapsed_time = time.time() - start_time
+    message = [
+        f"Archived {trades_count} trades",
+        f"Archived {transactions_count} transactions",
+        f"Elapsed {elapsed_time:.2f}s",
+    ]
+    event_entry = UtilityLogEntry(logtype=LogEntryType("Archive"),
+                                  timestamp=datetime.utcnow(),
+                                  author="/utils/archive API",
+                                  message=message,
+                                  inserted=trades_count + transactions_count,
+                                  elapsed=elapsed_time)
+    db.add_utility_event(event_entry)
+    return message
+
+@bp.route("/utils/pipeline", methods=["POST"])
+def run_pipeline():
+    """Run the batch job pipeline now, as the scheduler would.
+
+    Responds 409 while another worker or the scheduler is running it.
+    """
+    from traderev.pipeline import run_pipeline
+    res = run_pipeline(author="/utils/pipeline API")
+    if res is None:
+        abort(409)
+    return res
+
 @bp.route("/utils/log", methods=["GET"])
 def utility_log():
     event_type = request.args['type']
@@ -305,6 +482,20 @@ def utility_log():
     res = db.get_utility_events(event_type, event_count)
     return list(res)
 
+@bp.route("/utils/log/trends", methods=["GET"])
+def utility_log_trends():
+    """Daily duration and throughput of a batch job over the last `days` days.
+    """
+    try:
+        event_type = LogEntryType(request.args['type']).value
+        days = int(request.args.get('days', 90))
+    except (ValueError, KeyError):
+        abort(400)
+    if days < 1:
+        abort(400)
+    since = datetime.utcnow() - timedelta(days=days)
+    return db.get_utility_trends(event_type, since)
+
 @bp.route("/weeks/<day>", methods=["GET"])
 def get_week_by_date(day):
     res = db.get_week_by_date(day)
@@ -313,6 +504,7 @@ def get_week_by_date(day):
     return res
 
 @bp.route("/weeks/yearly", methods=["GET"])
+@cached_response("weeks")
 def get_weeks_by_year():
     try:
         year = int(request.args['year'] )
@@ -354,15 +546,9 @@ def add_tag_to_week(day):
         tag = request.args['tag']
     except KeyError:
         abort(400)
-    res = db.get_week_by_date(day)
-    week = TradingWeek(day)
-    # result from DB is a dictionary, we can construct the object from it.
-    if res:
-        week.from_dict(res)
-    week.add_tag(tag)
-    res = db.upsert_week(week)
-    if res.modified_count:
-        return make_response(week.tags, 201)
+    tags, added = db.add_tag_to_week(day, tag)
+    if added:
+        return make_response(tags, 201)
     return []
 
 @bp.route("/weeks/<day>/tags", methods=["DELETE"])
@@ -375,4 +561,134 @@ def delete_tag_from_week(day):
     res = db.delete_tag_from_week(day, tag)
     if res.modified_count:
         return make_response(get_tags_for_week(day), 201)
-    return make_response({}, 404)
\ No newline at end of file
+    return make_response({}, 404)
+
+def parse_tag_request():
+    """Parse a bulk tag request body.
+
+    Expects {"tags": [...], "entities": [{"parent_type": ..., "parent_id": ...}]}
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        tags = body['tags']
+        entities = [(e['parent_type'], e['parent_id']) for e in body['entities']]
+    except (KeyError, TypeError):
+        abort(400)
+    if not isinstance(tags, list) or not tags or not entities or \
+            not all(isinstance(t, str) and t.strip() for t in tags):
+        abort(400)
+    if any(parent_type not in db.annotation_types for parent_type, _ in entities):
+        abort(400)
+    entities = [(parent_type, parse_parent_id(parent_type, parent_id))
+                for parent_type, parent_id in entities]
+    return entities, tags
+
+@bp.route("/tags/bulk", methods=["POST"])
+def bulk_tag():
+    """Add tags to many trades, transactions, days or weeks at once.
+    """
+    entities, tags = parse_tag_request()
+    return db.tag_entities(entities, tags)
+
+@bp.route("/tags/bulk", methods=["DELETE"])
+def bulk_untag():
+    """Remove tags from many trades, transactions, days or weeks at once.
+    """
+    entities, tags = parse_tag_request()
+    return db.untag_entities(entities, tags)
+
+@bp.route("/tags/<tag>", methods=["GET"])
+def get_entities_by_tag(tag):
+    """List every entity carrying the tag.
+    """
+    parent_type = request.args.get('type')
+    if parent_type and parent_type not in db.annotation_types:
+        abort(400)
+    return db.get_entities_by_tag(tag, parent_type)
+
+def parse_parent_id(parent_type, parent_id):
+    """Transaction ids are integers, every other id is a string. A day is
+    identified by its date and a week by the date of its Monday.
+    """
+    if parent_type not in db.annotation_types:
+        abort(404)
+    if parent_type == "transaction":
+        try:
+            return int(parent_id)
+        except (ValueError, TypeError):
+            abort(400)
+    if not isinstance(parent_id, str):
+        abort(400)
+    if parent_type in ("day", "week"):
+        try:
+            day = datetime.strptime(parent_id, date_fmt)
+        except ValueError:
+            abort(400)
+        if parent_type == "week" and day.weekday() != 0:
+            abort(400)
+    return parent_id
+
+@bp.route("/annotations/<parent_type>/<parent_id>", methods=["GET"])
+def get_annotation(parent_type, parent_id):
+    """Tags and memos attached to one entity.
+    """
+    parent_id = parse_parent_id(parent_type, parent_id)
+    return db.get_annotation(parent_type, parent_id)
+
+@bp.route("/annotations/<parent_type>/<parent_id>/memos", methods=["POST"])
+def add_memo(parent_type, parent_id):
+    parent_id = parse_parent_id(parent_type, parent_id)
+    body = request.get_json(silent=True) or {}
+    text = body.get('memo')
+    if not text or not isinstance(text, str):
+        abort(400)
+    memo = Memo(parent_type, parent_id, text)
+    res = db.add_memo(memo)
+    doc = memo.to_doc()
+    doc['_id'] = res.inserted_id
+    return make_response(doc, 201)
+
+@bp.route("/annotations/<parent_type>/<parent_id>/memos/<memo_id>", methods=["DELETE"])
+def delete_memo(parent_type, parent_id, memo_id):
+    parent_id = parse_parent_id(parent_type, parent_id)
+    res = db.delete_memo(parent_type, parent_id, memo_id)
+    if not res or not res.deleted_count:
+        abort(404)
+    return make_response({}, 204)
+
+def ingest_format():
+    """Pick the ingest format from the content type, NDJSON by default.
+    """
+    if request.mimetype in ('text/csv', 'application/csv'):
+        return 'csv'
+    return 'ndjson'
+
+@bp.route("/ohlc/bulk", methods=["POST"])
+def ohlc_bulk():
+    """Ingest a file of OHLC bars, as NDJSON or CSV with a header row.
+    """
+    batch_size = app.config.get('OHLC_BATCH_SIZE', 1000)
+    res = ingest(request.stream, ingest_format(), batch_size)
+    return make_response(res, 201)
+
+@bp.route("/ohlc/stream", methods=["POST"])
+def ohlc_stream():
+    """Ingest a long running, chunked upload of NDJSON bars.
+
+    Partial batches are written every OHLC_FLUSH_SECONDS as lines arrive.
+    """
+    batch_size = app.config.get('OHLC_BATCH_SIZE', 1000)
+    flush_seconds = app.config.get('OHLC_FLUSH_SECONDS', 1.0)
+    res = ingest(request.stream, ingest_format(), batch_size, flush_seconds)
+    return make_response(res, 201)
+
+@bp.route("/trades/<string:trade_id>/ohlc", methods=["GET"])
+def get_trade_ohlc(trade_id):
+    """OHLC bars of the trade's symbol while the trade was open.
+    """
+    trade = db.get_trade_by_id(trade_id)
+    if not trade:
+        abort(404)
+    end = trade['closingdate'] or datetime.utcnow()
+    res = db.get_ohlc_bars(trade['symbol'], trade['openingdate'], end)
+    return list(res)
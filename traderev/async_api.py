@@ -0,0 +1,119 @@
+"""Optional ASGI serving mode for read heavy dashboards.
+
+Serves the read endpoints with Quart and the async client in async_db, so
+endpoints needing several independent queries can run them concurrently.
+See asgi.py for the entry point.
+"""
+import asyncio
+from datetime import datetime
+from quart import Blueprint, Quart, abort, request
+from quart_cors import cors
+from traderev import async_db, load_mongo_config
+from traderev.schemas import TradingWeek
+from traderev.utils import JSONProvider, date_fmt, week_range
+
+bp = Blueprint("async_api", __name__, url_prefix="/api")
+
+def create_asgi_app(test_config=None):
+    """Quart app factory"""
+    app = Quart(__name__)
+    app.config.from_mapping(SECRET_KEY='dev')
+    if test_config:
+        app.config.from_mapping(test_config)
+    app.register_blueprint(bp)
+    app = cors(app, allow_origin="*")
+    app.json = JSONProvider(app)
+    load_mongo_config(app)
+    async_db.init_app(app)
+    return app
+
+@bp.route("/transactions/<int:trans_id>", methods=["GET"])
+async def transaction_by_id(trans_id):
+    res = await async_db.get_transaction_by_id(trans_id)
+    if not res:
+        abort(404)
+    return res
+
+@bp.route("/trades", methods=["GET"])
+async def get_trades():
+    num = None
+    try:
+        num = int(request.args['n'])
+    except KeyError:
+        pass
+    except ValueError:
+        abort(400)
+    # MongoDB rejects a $limit below 1
+    if num is not None and num < 1:
+        abort(400)
+    return await async_db.get_trades(num)
+
+@bp.route("/trades/<string:trade_id>", methods=["GET"])
+async def get_trade_by_id(trade_id):
+    res = await async_db.get_trade_by_id(trade_id)
+    if not res:
+        abort(404)
+    return res
+
+@bp.route("/stats/daily", methods=["GET"])
+async def daily_stats():
+    try:
+        day = datetime.strptime(request.args['day'], date_fmt).date()
+    except (ValueError, KeyError):
+        abort(400)
+    res = await async_db.get_stats_by_date(day)
+    if not res:
+        abort(404)
+    return res
+
+@bp.route("/stats/weekly", methods=["GET"])
+async def weekly_stats():
+    try:
+        start_date, end_date = week_range(request.args['week'])
+    except (ValueError, KeyError):
+        abort(400)
+    res = await async_db.get_stats_by_date_range(start_date, end_date)
+    if not res:
+        abort(404)
+    return res
+
+@bp.route("/weeks/<day>", methods=["GET"])
+async def get_week_by_date(day):
+    res = await async_db.get_week_by_date(day)
+    if not res:
+        abort(404)
+    return res
+
+@bp.route("/weeks/<day>/tags", methods=["GET"])
+async def get_tags_for_week(day):
+    res = await async_db.get_tags_for_week(day)
+    if not res or 'tags' not in res:
+        abort(404)
+    return res['tags']
+
+@bp.route("/dashboard", methods=["GET"])
+async def dashboard():
+    """Week tags, weekly and daily stats and recent trades in one response,
+    all queries run concurrently.
+    """
+    try:
+        start_date, end_date = week_range(request.args['week'])
+        num = int(request.args.get('n', 10))
+    except (ValueError, KeyError):
+        abort(400)
+    if num < 1:
+        abort(400)
+    week = TradingWeek(datetime.strftime(start_date, date_fmt))
+    tags, weekly, recent, *daily = await asyncio.gather(
+        async_db.get_tags_for_week(week.start_date),
+        async_db.get_stats_by_date_range(start_date, end_date),
+        async_db.get_trades(num),
+        *(async_db.get_stats_by_date(day) for day in week.weekdays),
+    )
+    return {
+        'week': week.start_date,
+        'tags': (tags or {}).get('tags', []),
+        'weekly_stats': weekly,
+        'daily_stats': dict(zip(week.weekdays, daily)),
+        'recent_trades': recent,
+    }
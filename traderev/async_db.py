@@ -0,0 +1,123 @@
+"""Async versions of the read functions in db.py, for the ASGI app.
+
+Built on PyMongo's AsyncMongoClient. The client is bound to the event loop of
+the serving process, it is opened and closed with the app.
+"""
+from datetime import datetime
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import AsyncMongoClient
+from quart import current_app
+from werkzeug.local import LocalProxy
+from .db import (basic_stats_stages, convert_closing_date, make_read_preference,
+        with_archive)
+
+def init_app(app):
+    """Open the client when the app starts serving and close it on shutdown.
+    """
+    @app.before_serving
+    async def open_client():
+        app.extensions['async_mongo'] = AsyncMongoClient(app.config['MONGO_URI'])
+
+    @app.after_serving
+    async def close_client():
+        client = app.extensions.pop('async_mongo', None)
+        if client:
+            await client.close()
+
+def get_db():
+    """Return the default database of the async client.
+
+    Every function here is a read for stats or lists, so the database uses
+    the 'analytics' read preference from MONGO_READ_PREFERENCES.
+    """
+    preferences = current_app.config.get('MONGO_READ_PREFERENCES', {})
+    max_staleness = current_app.config.get('MONGO_MAX_STALENESS_SECONDS', -1)
+    read_preference = make_read_preference(preferences.get('analytics', 'primary'),
+                                           max_staleness)
+    client = current_app.extensions['async_mongo']
+    return client.get_default_database(read_preference=read_preference)
+
+db = LocalProxy(get_db)
+
+async def _basic_stats(pipeline, after=()):
+    """Run the trades pipeline, over hot and archived trades, followed by the
+    stats stages.
+
+    Returns None when no trades matched.
+    """
+    pipeline = with_archive("trades", pipeline, list(after) + basic_stats_stages)
+    cursor = await db.trades.aggregate(pipeline)
+    async for r in cursor:
+        return r
+
+async def get_transaction_by_id(trans_id):
+    """Get one transaction by the broker's transaction Id.
+    """
+    res = await db.transactions.find_one({"id": trans_id}, {"_id": 0})
+    if res is None:
+        res = await db.transactions_archive.find_one({"id": trans_id}, {"_id": 0})
+    return res
+
+async def get_trades(num: int = None):
+    """Get all trades, or the last N closed trades, including archived ones.
+    """
+    if num:
+        match = {"$match": {"closingdate": {"$ne": 0}}}
+        sort = {"$sort": {"closingdate": -1}}
+        limit = {"$limit": num}
+        pipeline = with_archive("trades", [match, sort, limit], [sort, limit])
+    else:
+        pipeline = with_archive("trades", [])
+    cursor = await db.trades.aggregate(pipeline)
+    return await cursor.to_list()
+
+async def get_trade_by_id(trade_id: str):
+    """Get one trade by its ObjectId.
+    """
+    try:
+        trade_id = ObjectId(trade_id)
+    except InvalidId:
+        return None
+    res = await db.trades.find_one({"_id": trade_id})
+    if res is None:
+        res = await db.trades_archive.find_one({"_id": trade_id})
+    return res
+
+async def get_stats_by_trades(num: int = None):
+    """Compute basic stats server side for all trades, or for the last N
+    closed trades.
+    """
+    if num:
+        match = {"$match": {"closingdate": {"$ne": 0}}}
+        sort = {"$sort": {"closingdate": -1}}
+        limit = {"$limit": num}
+        return await _basic_stats([match, sort, limit], [sort, limit])
+    return await _basic_stats([])
+
+async def get_stats_by_date_range(start: datetime, end: datetime):
+    """Compute basic stats server side for trades closed between start and
+    end dates.
+    """
+    valid_date = {"$match" : {"closingdate": {"$ne": 0}}}
+    match_date = {"$match": {"closingdate": {"$gte": start, "$lte": end}}}
+    return await _basic_stats([valid_date, match_date])
+
+async def get_stats_by_date(day: str):
+    """Compute basic stats server side for trades closed on the specified day.
+    """
+    valid_date = {"$match": {"closingdate": {"$ne": 0}}}
+    match_date = {"$match": {"closeDate": f"{day}"}}
+    return await _basic_stats([valid_date, convert_closing_date, match_date])
+
+async def get_week_by_date(day):
+    """Fetch one week identified by date
+    """
+    return await db.weeks.find_one({"start_date": day}, {"_id": 0})
+
+async def get_tags_for_week(day):
+    """Fetch just the tags for a given week
+    """
+    match = {"start_date": day}
+    project = {"tags": 1, "_id": 0}
+    return await db.weeks.find_one(match, project)
@@ -0,0 +1,138 @@
+"""Response compression and caching of encoded payloads.
+
+Responses are compressed with brotli or gzip, as negotiated through the
+Accept-Encoding header, once they are larger than COMPRESS_MIN_SIZE bytes.
+
+Views whose output only depends on the contents of a few collections can be
+wrapped with `cached_response`, which keeps the already encoded and
+compressed bytes around until one of those collections changes version.
+"""
+import functools
+import gzip
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from flask import current_app, request
+from traderev import db
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+default_min_size = 1024
+default_cache_bytes = 32 * 1024 * 1024
+
+def negotiate_encoding():
+    """Pick the preferred encoding accepted by the client, or None.
+    """
+    accepted = request.accept_encodings
+    gzip_quality = accepted.quality('gzip')
+    if brotli and accepted.quality('br') and accepted.quality('br') >= gzip_quality:
+        return 'br'
+    if gzip_quality:
+        return 'gzip'
+    return None
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress data with the given content encoding.
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=current_app.config.get('BROTLI_QUALITY', 5))
+    return gzip.compress(data, compresslevel=current_app.config.get('GZIP_LEVEL', 6))
+
+def compress_response(response, encoding: str):
+    """Compress the response body in place when it is worth it.
+    """
+    if not encoding or response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    data = response.get_data()
+    if len(data) < current_app.config.get('COMPRESS_MIN_SIZE', default_min_size):
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+class PayloadCache():
+    """A least recently used cache of response bodies bounded by total size.
+    """
+
+    def __init__(self, max_bytes: int = default_cache_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body: bytes, headers: dict):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = (body, headers)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+payload_cache = PayloadCache()
+
+def cached_response(*collections):
+    """Cache the encoded and compressed response of a view until any of the
+    given collections changes version.
+
+    The current UTC date is part of the cache key so payloads which depend
+    on today's date, such as the weeks of the current year, roll over.
+    A response is only cached when the versions did not change while the
+    view ran, the body could otherwise predate a concurrent write.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            encoding = negotiate_encoding()
+            base_key = (request.endpoint, tuple(sorted(kwargs.items())),
+                        tuple(sorted(request.args.items(multi=True))),
+                        datetime.utcnow().date(), encoding)
+            versions = tuple(db.get_collection_version(c) for c in collections)
+            cached = payload_cache.get(base_key + versions)
+            if cached:
+                body, headers = cached
+                return current_app.response_class(body, headers=headers)
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            compress_response(response, encoding)
+            # written meanwhile, by the view itself or another request
+            if versions != tuple(db.get_collection_version(c) for c in collections):
+                return response
+            headers = {k: v for k, v in response.headers.items()
+                       if k != 'Content-Length'}
+            payload_cache.put(base_key + versions, response.get_data(), headers)
+            return response
+        return wrapper
+    return decorator
+
+def init_app(app):
+    """Compress every response leaving the app.
+    """
+    payload_cache.max_bytes = app.config.get('PAYLOAD_CACHE_BYTES', default_cache_bytes)
+
+    @app.after_request
+    def compress_after_request(response):
+        return compress_response(response, negotiate_encoding())
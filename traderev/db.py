@@ -1,12 +1,16 @@
 from copy import deepcopy
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import current_app, g
 from flask_pymongo import PyMongo
 from werkzeug.local import LocalProxy
 from .utils import flatten_dict, date_fmt
 from bson import ObjectId
 from bson.errors import InvalidId
-from .schemas import TradingWeek
+from pymongo import UpdateOne, WriteConcern
+from pymongo.read_preferences import (Nearest, Primary, PrimaryPreferred,
+        Secondary, SecondaryPreferred)
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+from .schemas import Memo, TradingWeek
 
 def get_db():
     """Configuration method to return a db instance
@@ -20,6 +24,93 @@ def get_db():
     return db
 
 db = LocalProxy(get_db)
+
+# Names of the ensure_*_indexes functions this process already ran.
+ensured_indexes = set()
+
+def ensure_indexes_once(ensure):
+    """Run an ensure_*_indexes function the first time this process relies
+    on its indexes, instead of on every request.
+    """
+    if ensure.__name__ not in ensured_indexes:
+        ensure()
+        ensured_indexes.add(ensure.__name__)
+
+read_preference_modes = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+# Read functions routed through db_for, which MONGO_READ_PREFERENCES can name.
+routed_reads = (
+    "count_closed_trades",
+    "get_all_transactions",
+    "get_closed_trades_by_date",
+    "get_closed_trades_by_date_range",
+    "get_closed_trades_pnl",
+    "get_entities_by_tag",
+    "get_ohlc_bars",
+    "get_open_positions",
+    "get_opened_trades_by_date",
+    "get_stats_breakdown",
+    "get_stats_by_date",
+    "get_stats_by_date_range",
+    "get_stats_by_trades",
+    "get_trade_with_transactions",
+    "get_trades",
+    "get_trades_toc",
+    "get_transactions_by_date",
+    "get_transactions_by_ids",
+    "get_utility_events",
+    "get_utility_trends",
+)
+
+def validate_read_preferences(preferences: dict, max_staleness: int):
+    """Check MONGO_READ_PREFERENCES and MONGO_MAX_STALENESS_SECONDS when the
+    app starts, rather than failing every routed read.
+
+    Raises ValueError for unknown function names or modes, and for a max
+    staleness other than -1 below MongoDB's 90 seconds minimum.
+    """
+    for name, mode in preferences.items():
+        if name != "analytics" and name not in routed_reads:
+            raise ValueError(f"No routed read named {name}")
+        if mode not in read_preference_modes:
+            raise ValueError(f"Unknown read preference for {name}: {mode}")
+    if max_staleness != -1 and max_staleness < 90:
+        raise ValueError("max_staleness_seconds must be -1 or at least 90")
+
+def make_read_preference(mode: str, max_staleness: int = -1):
+    """Build a pymongo read preference from its mode name.
+
+    MongoDB requires max_staleness to be at least 90 seconds, or -1 for no
+    limit.
+    """
+    if mode not in read_preference_modes:
+        raise ValueError(f"Unknown read preference: {mode}")
+    if mode == "primary":
+        return Primary()
+    return read_preference_modes[mode](max_staleness=max_staleness)
+
+def db_for(name: str):
+    """Database handle with the read preference configured for a read
+    function.
+
+    Functions reading for stats, exports and lists call this with their own
+    name, listed in routed_reads. MONGO_READ_PREFERENCES maps function names,
+    or 'analytics' for all of them, to a read preference mode; anything not
+    configured reads from the primary.
+    """
+    preferences = current_app.config.get('MONGO_READ_PREFERENCES', {})
+    mode = preferences.get(name, preferences.get('analytics', 'primary'))
+    if mode == "primary":
+        return db
+    max_staleness = current_app.config.get('MONGO_MAX_STALENESS_SECONDS', -1)
+    return db.with_options(read_preference=make_read_preference(mode, max_staleness))
+
 convert_transactiondate = {
     "$addFields": {
         "openDate": {
@@ -42,6 +133,119 @@ convert_closing_date = {
             }
         }
     }
+# Reduces a stream of trade documents to the same figures as
+# utils.compute_basic_stats, so only a single small document leaves the server.
+basic_stats_group = {
+    "$group": {
+        "_id": None,
+        "total_trades": {"$sum": 1},
+        "gross_pnl": {"$sum": "$profitdollars"},
+        "call_count": {
+            "$sum": {"$cond": [{"$eq": ["$putcall", "CALL"]}, 1, 0]}
+        },
+        "put_count": {
+            "$sum": {"$cond": [{"$eq": ["$putcall", "PUT"]}, 1, 0]}
+        },
+        "total_commission": {"$sum": "$totalcommission"},
+        "total_fees": {"$sum": "$totalfees"},
+        "max_gain_dollars": {"$max": "$profitdollars"},
+        "max_gain_percent": {"$max": "$profitpercent"},
+        "win_count": {
+            "$sum": {"$cond": [{"$gt": ["$profitdollars", 0]}, 1, 0]}
+        },
+        "gross_profit": {
+            "$sum": {"$cond": [{"$gt": ["$profitdollars", 0]}, "$profitdollars", 0]}
+        },
+        "gross_loss": {
+            "$sum": {"$cond": [{"$lt": ["$profitdollars", 0]}, "$profitdollars", 0]}
+        },
+        # $avg, $min and $max skip nulls, so non matching trades are ignored.
+        "avg_gain_dollars": {
+            "$avg": {"$cond": [{"$gt": ["$profitdollars", 0]}, "$profitdollars", None]}
+        },
+        "avg_gain_percent": {
+            "$avg": {"$cond": [{"$gt": ["$profitdollars", 0]}, "$profitpercent", None]}
+        },
+        "max_loss_dollars": {
+            "$min": {"$cond": [{"$lt": ["$profitdollars", 0]}, "$profitdollars", None]}
+        },
+        "max_loss_percent": {
+            "$min": {"$cond": [{"$lt": ["$profitdollars", 0]}, "$profitpercent", None]}
+        },
+        "avg_loss_dollars": {
+            "$avg": {"$cond": [{"$lt": ["$profitdollars", 0]}, "$profitdollars", None]}
+        },
+        "avg_loss_percent": {
+            "$avg": {"$cond": [{"$lt": ["$profitdollars", 0]}, "$profitpercent", None]}
+        },
+    }
+}
+basic_stats_project = {
+    "$project": {
+        "_id": 0,
+        "total_trades": 1,
+        "gross_pnl": 1,
+        "call_count": 1,
+        "put_count": 1,
+        "total_commission": 1,
+        "total_fees": 1,
+        "max_gain_dollars": 1,
+        "max_gain_percent": 1,
+        "max_loss_dollars": {"$ifNull": ["$max_loss_dollars", 0]},
+        "max_loss_percent": {"$ifNull": ["$max_loss_percent", 0]},
+        "avg_loss_percent": {"$ifNull": ["$avg_loss_percent", 0]},
+        "avg_loss_dollars": {"$ifNull": ["$avg_loss_dollars", 0]},
+        "avg_gain_dollars": {"$ifNull": ["$avg_gain_dollars", 0]},
+        "avg_gain_percent": {"$ifNull": ["$avg_gain_percent", 0]},
+        "win_rate": {
+            "$multiply": [{"$divide": ["$win_count", "$total_trades"]}, 100]
+        },
+        # pandas yields inf/nan here, mongo would raise; report null instead.
+        "profit_factor": {
+            "$cond": [
+                {"$eq": ["$gross_loss", 0]},
+                None,
+                {"$divide": ["$gross_profit", "$gross_loss"]}
+            ]
+        },
+        "total_pnl": {
+            "$subtract": ["$gross_pnl", {"$add": ["$total_commission", "$total_fees"]}]
+        },
+    }
+}
+basic_stats_stages = [basic_stats_group, basic_stats_project]
+
+def with_archive(collection: str, stages, after=()):
+    """Build a pipeline running stages over a collection and its archive.
+
+    The stages run separately on both collections so their $match stages
+    can use each collection's indexes, `after` runs on the combined stream.
+
+    Parameters
+    ----------
+        collection : str Either 'trades' or 'transactions'.
+        stages : list of pipeline stages.
+        after : list of pipeline stages.
+    """
+    union = {"$unionWith": {"coll": archive_name(collection), "pipeline": list(stages)}}
+    return list(stages) + [union] + list(after)
+
+def archive_name(collection: str) -> str:
+    """Name of the cold storage collection of a hot collection.
+    """
+    return f"{collection}_archive"
+
+def _basic_stats(name, pipeline, after=()):
+    """Run the trades pipeline, over hot and archived trades, followed by the
+    stats stages. name is the calling function, for its read preference.
+
+    Returns None when no trades matched.
+    """
+    pipeline = with_archive("trades", pipeline, list(after) + basic_stats_stages)
+    res = db_for(name).trades.aggregate(pipeline)
+    for r in res:
+        return r
+
 def get_transaction_by_id(trans_id):
     """Get one transaction by Id.
 
@@ -54,14 +258,44 @@ def get_transaction_by_id(trans_id):
         trans_id : int
     """
     res = db.transactions.find_one({"id": trans_id}, {"_id": 0})
+    if res is None:
+        res = db.transactions_archive.find_one({"id": trans_id}, {"_id": 0})
+    return res
+
+def get_transactions_by_ids(trans_ids):
+    """Get many transactions by their broker transaction Id in one query,
+    falling through to the archive for the ids not found.
+
+    Masks the _id field from output.
+
+    Parameters
+    ----------
+        trans_ids : list of int
+    """
+    ensure_indexes_once(ensure_transaction_indexes)
+    match = {"id": {"$in": trans_ids}}
+    res = list(db_for("get_transactions_by_ids").transactions.find(match, {"_id": 0}))
+    missing = set(trans_ids).difference(tr["id"] for tr in res)
+    if missing:
+        match = {"id": {"$in": list(missing)}}
+        res.extend(db_for("get_transactions_by_ids").transactions_archive.find(match, {"_id": 0}))
     return res
 
+def ensure_transaction_indexes():
+    """Create the unique index on the broker transaction Id.
+    """
+    try:
+        db.transactions.create_index("id", unique=True, background=True)
+    except OperationFailure as e:
+        current_app.logger.warning("Unique transaction id index not created: %s", e)
+
 def get_all_transactions():
-    """Get all transactions in the collection
+    """Get all transactions in the collection, including archived ones.
     Masks the _id field.
     """
-    res = db.transactions.find({}, {"_id": 0}) \
-    .sort([("transactiondate", -1)])
+    project = {"$project": {"_id": 0}}
+    sort = {"$sort": {"transactiondate": -1}}
+    res = db_for("get_all_transactions").transactions.aggregate(with_archive("transactions", [project], [sort]))
     return res
 
 def get_transactions_by_date(day: str):
@@ -76,16 +310,19 @@ def get_transactions_by_date(day: str):
     match_date = {"$match": {"openDate": f"{day}"}}
     project = {"$project": {"_id": 0}}
     pipeline = [convert_transactiondate, match_date, project]
-    res = db.transactions.aggregate(pipeline)
+    res = db_for("get_transactions_by_date").transactions.aggregate(with_archive("transactions", pipeline))
     return res
 
 def get_trades(num: int = None):
-    """Get all trades in the trades collection.
+    """Get all trades in the trades collection, including archived ones.
     """
     if num:
-        match = {"closingdate": {"$ne": 0}}
-        return db.trades.find(match).sort("closingdate", -1).limit(num)
-    return db.trades.find()
+        match = {"$match": {"closingdate": {"$ne": 0}}}
+        sort = {"$sort": {"closingdate": -1}}
+        limit = {"$limit": num}
+        pipeline = with_archive("trades", [match, sort, limit], [sort, limit])
+        return db_for("get_trades").trades.aggregate(pipeline)
+    return db_for("get_trades").trades.aggregate(with_archive("trades", []))
 
 def get_trade_by_id(trade_id: str):
     """Get all trades in the trades collection.
@@ -94,9 +331,58 @@ def get_trade_by_id(trade_id: str):
         trade_id = ObjectId(trade_id)
     except InvalidId:
         return None 
-    return db.trades.find_one({"_id": trade_id})
+    res = db.trades.find_one({"_id": trade_id})
+    if res is None:
+        res = db.trades_archive.find_one({"_id": trade_id})
+    return res
 
 
+def get_trade_with_transactions(trade_id: str):
+    """Get one trade with its opening and closing transactions embedded in
+    place of the {id, amount} references.
+    """
+    try:
+        trade_id = ObjectId(trade_id)
+    except InvalidId:
+        return None
+    ensure_indexes_once(ensure_transaction_indexes)
+    match = {"$match": {"_id": trade_id}}
+    expand = []
+    for side in ("opening", "closing"):
+        field = f"{side}transactions"
+        for collection in ("transactions", archive_name("transactions")):
+            expand.append({
+                "$lookup": {
+                    "from": collection,
+                    "localField": f"{field}.id",
+                    "foreignField": "id",
+                    "as": f"_{side}_{collection}",
+                }
+            })
+        expand.append({
+            "$set": {
+                field: {
+                    "$concatArrays": [
+                        f"$_{side}_transactions", f"$_{side}_transactions_archive"
+                    ]
+                }
+            }
+        })
+    mask = {
+        "$project": {
+            "_opening_transactions": 0,
+            "_opening_transactions_archive": 0,
+            "_closing_transactions": 0,
+            "_closing_transactions_archive": 0,
+            "openingtransactions._id": 0,
+            "closingtransactions._id": 0,
+        }
+    }
+    pipeline = with_archive("trades", [match], [{"$limit": 1}] + expand + [mask])
+    res = db_for("get_trade_with_transactions").trades.aggregate(pipeline)
+    for r in res:
+        return r
+
 def get_opened_trades_by_date(day: str):
     """Get all trades opened on the specified day.
 
@@ -118,7 +404,7 @@ def get_opened_trades_by_date(day: str):
     }
     match_date = {"$match": {"openDate": f"{day}"}}
     pipeline = [date_convert, match_date]
-    res = db.trades.aggregate(pipeline)
+    res = db_for("get_opened_trades_by_date").trades.aggregate(with_archive("trades", pipeline))
     return res
 
 def get_closed_trades_by_date_range(start: datetime, end: datetime):
@@ -133,9 +419,42 @@ def get_closed_trades_by_date_range(start: datetime, end: datetime):
     match_date = {"$match": {"closingdate": {"$gte": start, "$lte": end}}}
 
     pipeline = [valid_date, match_date]
-    res = db.trades.aggregate(pipeline)
+    res = db_for("get_closed_trades_by_date_range").trades.aggregate(with_archive("trades", pipeline))
+    return list(res)
+
+def get_closed_trades_pnl(since: datetime = None):
+    """Get the profit of fully closed trades in closing date order.
+
+    Only `closingdate` and `pnl` are projected, `pnl` is computed the same way
+    as `profitdollars` so it does not depend on the profits batch job.
+
+    Parameters
+    ----------
+        since : datetime Only return trades closed after this date.
+    """
+    match = {"openamount": 0, "closingdate": {"$ne": 0}}
+    if since:
+        match["closingdate"] = {"$gt": since}
+    project = {
+        "$project": {
+            "closingdate": 1,
+            "pnl": {"$sum": ["$openingprice", "$closingprice"]}
+        }
+    }
+    sort = {"$sort": {"closingdate": 1, "_id": 1}}
+    mask_id = {"$project": {"_id": 0}}
+    pipeline = with_archive("trades", [{"$match": match}, project], [sort, mask_id])
+    res = db_for("get_closed_trades_pnl").trades.aggregate(pipeline)
     return list(res)
 
+def count_closed_trades(until: datetime):
+    """Count fully closed trades with a closing date up to and including until.
+    """
+    match = {"openamount": 0, "closingdate": {"$ne": 0, "$lte": until}}
+    reader = db_for("count_closed_trades")
+    return reader.trades.count_documents(match) + \
+        reader.trades_archive.count_documents(match)
+
 def get_closed_trades_by_date(day: str):
     """Get all trades closed on the specified day.
 
@@ -149,24 +468,137 @@ def get_closed_trades_by_date(day: str):
     match_date = {"$match": {"closeDate": f"{day}"}}
     project = {"$project": {"_id": 0}}
     pipeline = [valid_date, convert_closing_date, match_date, project]
-    res = db.trades.aggregate(pipeline)
+    res = db_for("get_closed_trades_by_date").trades.aggregate(with_archive("trades", pipeline))
+    return list(res)
+
+def get_stats_by_trades(num: int = None):
+    """Compute basic stats server side for all trades, or for the last N
+    closed trades.
+
+    Parameters
+    ----------
+        num : int
+    """
+    if num:
+        match = {"$match": {"closingdate": {"$ne": 0}}}
+        sort = {"$sort": {"closingdate": -1}}
+        limit = {"$limit": num}
+        return _basic_stats("get_stats_by_trades", [match, sort, limit], [sort, limit])
+    return _basic_stats("get_stats_by_trades", [])
+
+def get_stats_by_date_range(start: datetime, end: datetime):
+    """Compute basic stats server side for trades closed between start and
+    end dates.
+
+    Parameters
+    ----------
+        start : datetime
+        end : datetime
+    """
+    valid_date = {"$match" : {"closingdate": {"$ne": 0}}}
+    match_date = {"$match": {"closingdate": {"$gte": start, "$lte": end}}}
+    return _basic_stats("get_stats_by_date_range", [valid_date, match_date])
+
+def get_stats_by_date(day: str):
+    """Compute basic stats server side for trades closed on the specified day.
+
+    Parameters
+    ----------
+        day : str
+    """
+    valid_date = {"$match": {"closingdate": {"$ne": 0}}}
+    match_date = {"$match": {"closeDate": f"{day}"}}
+    return _basic_stats("get_stats_by_date", [valid_date, convert_closing_date, match_date])
+
+weekday_names = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday",
+                 "Saturday", "Sunday"]
+ms_per_day = 24 * 60 * 60 * 1000
+# Group key expressions for each dimension supported by get_stats_breakdown.
+stats_dimensions = {
+    "underlying": "$underlying",
+    "putcall": "$putcall",
+    "weekday": {
+        "$arrayElemAt": [
+            weekday_names, {"$subtract": [{"$isoDayOfWeek": "$closingdate"}, 1]}
+        ]
+    },
+    "holding": {
+        "$let": {
+            "vars": {
+                "days": {
+                    "$divide": [
+                        {"$subtract": ["$closingdate", "$openingdate"]}, ms_per_day
+                    ]
+                }
+            },
+            "in": {
+                "$switch": {
+                    "branches": [
+                        {"case": {"$lt": ["$$days", 1]}, "then": "intraday"},
+                        {"case": {"$lt": ["$$days", 5]}, "then": "1-4 days"},
+                        {"case": {"$lt": ["$$days", 30]}, "then": "5-29 days"},
+                    ],
+                    "default": "30+ days"
+                }
+            }
+        }
+    },
+}
+
+def get_stats_breakdown(dimensions, start: datetime = None, end: datetime = None,
+                        sort: str = "total_trades", num: int = None):
+    """Compute basic stats server side for closed trades, grouped by every
+    combination of the given dimensions, in a single aggregation.
+
+    Parameters
+    ----------
+        dimensions : list of keys from stats_dimensions
+        start : datetime Only trades closed on or after start.
+        end : datetime Only trades closed on or before end.
+        sort : str Stats field to sort the groups by, in descending order.
+        num : int Only return the top N groups.
+    """
+    closingdate = {"$ne": 0}
+    if start:
+        closingdate["$gte"] = start
+    if end:
+        closingdate["$lte"] = end
+    match = {"$match": {"closingdate": closingdate}}
+    group = deepcopy(basic_stats_group)
+    group["$group"]["_id"] = {d: stats_dimensions[d] for d in dimensions}
+    project = deepcopy(basic_stats_project)
+    project["$project"].update({d: f"$_id.{d}" for d in dimensions})
+    order = {sort: -1}
+    order.update({d: 1 for d in dimensions})
+    pipeline = with_archive("trades", [match], [group, project, {"$sort": order}])
+    if num:
+        pipeline.append({"$limit": num})
+    res = db_for("get_stats_breakdown").trades.aggregate(pipeline)
     return list(res)
 
-def get_opening_transactions():
+def get_opening_transactions(pending: bool = False):
     """Get all transactions with openingeffect equal to 'OPENING'
     """
-    return get_transactions_by_effect("OPENING")
+    return get_transactions_by_effect("OPENING", pending)
 
-def get_closing_transactions():
+def get_closing_transactions(pending: bool = False):
     """Get all transactions with openingeffect equal to 'CLOSING'
     """
-    return get_transactions_by_effect("CLOSING")
+    return get_transactions_by_effect("CLOSING", pending)
+
+def get_transactions_by_effect(effect: str, pending: bool = False):
+    """Get transactions with matching positioneffect, mask _id in projection.
 
-def get_transactions_by_effect(effect: str):
-    """Get transactions with matching positioneffect, mask _id in projection."""
+    Archived transactions are left out, they are already part of a trade.
+    With pending only the transactions not yet marked as processed are
+    returned.
+    """
     project = {"$project" : {"_id" : 0}}
     match_open = {"$match" : {"positioneffect": effect}}
-    pipeline = [convert_transactiondate, match_open, project]
+    if pending:
+        match_open["$match"]["processed"] = {"$ne": 1}
+    sort = {"$sort": {"transactiondate": 1, "id": 1}}
+    pipeline = [match_open, sort, convert_transactiondate, project]
     res = db.transactions.aggregate(pipeline)
     return list(res)
 
@@ -178,7 +610,7 @@ def get_trades_opening_transaction_ids():
     newroot = {"$replaceRoot": {"newRoot": "$openingtransactions"}}
     project = {"$project": {"id": 1}}
     pipeline = [unwind, newroot, project]
-    res = db.trades.aggregate(pipeline)
+    res = db.trades.aggregate(with_archive("trades", pipeline))
     return list(res)
 
 def get_trades_closing_transaction_ids():
@@ -189,42 +621,136 @@ def get_trades_closing_transaction_ids():
     newroot = {"$replaceRoot": {"newRoot": "$closingtransactions"}}
     project = {"$project": {"id": 1}}
     pipeline = [unwind, newroot, project]
-    res = db.trades.aggregate(pipeline)
+    res = db.trades.aggregate(with_archive("trades", pipeline))
     return list(res)
 
+def get_tracked_transaction_ids(field: str, ids):
+    """Get which of the transaction ids are already listed by a trade.
+
+    Parameters
+    ----------
+        field : 'openingtransactions' or 'closingtransactions'
+        ids : list of transaction ids
+    """
+    ids = list(ids)
+    if not ids:
+        return set()
+    match = {f"{field}.id": {"$in": ids}}
+    tracked = set(db.trades.distinct(f"{field}.id", match))
+    tracked.update(db.trades_archive.distinct(f"{field}.id", match))
+    return tracked.intersection(ids)
+
+def ensure_trade_indexes():
+    """Create the indexes of the trades collection.
+
+    The unique trade key index is what makes rebuilds idempotent, it can't
+    be created while duplicate trades exist.
+    """
+    db.trades.create_index("symbol", background=True)
+    db.trades.create_index("openingdate", background=True)
+    db.trades.create_index("closingdate", background=True)
+    db.trades.create_index("modified", background=True)
+    db.trades.create_index("openingtransactions.id", background=True)
+    db.trades.create_index("closingtransactions.id", background=True)
+    # hold open trades only, lookups stay small as closed trades accumulate
+    open_trades = {"openamount": {"$gt": 0}}
+    db.trades.create_index([("openingdate", 1)], name="open_by_date",
+                           partialFilterExpression=open_trades, background=True)
+    db.trades.create_index([("symbol", 1), ("openingdate", 1)], name="open_by_symbol",
+                           partialFilterExpression=open_trades, background=True)
+    db.trades.create_index([("underlying", 1), ("openingdate", 1)], name="open_by_underlying",
+                           partialFilterExpression=open_trades, background=True)
+    key = [("symbol", 1), ("openingdate", 1), ("openingtransactions.id", 1)]
+    try:
+        db.trades.create_index(key, unique=True, background=True)
+    except OperationFailure as e:
+        current_app.logger.warning("Unique trade key index not created: %s", e)
+
+def trades_collection():
+    """The trades collection with the write concern used by trade builds.
+    """
+    w = current_app.config.get('TRADES_WRITE_CONCERN', 'majority')
+    return db.trades.with_options(write_concern=WriteConcern(w=w, j=True))
+
+def write_trades(ops):
+    """Apply a batch of trade updates, in order.
+    """
+    return trades_collection().bulk_write(ops, ordered=True)
+
+def trade_key(trade):
+    """The unique key of a trade: symbol, opening date and opening transaction.
+    """
+    return {
+        "symbol": trade['symbol'],
+        "openingdate": trade['openingdate'],
+        "openingtransactions": {
+            "$elemMatch": {"id": trade['openingtransactions'][0]['id']}
+        },
+    }
+
 def create_trade(trade_doc):
-    """Insert a single trade document into collection
+    """Insert a single trade document into collection, unless a trade with
+    the same key already exists.
     """
-    res = db.trades.insert_one(trade_doc)
+    match = trade_key(trade_doc)
+    res = trades_collection().update_one(match, {"$setOnInsert": trade_doc}, upsert=True)
     return res
 
+def get_open_trades():
+    """Get every trade which is still open, oldest first.
+
+    Served by the partial open_by_date index, which only holds open trades.
+    """
+    return db.trades.find({"openamount": {"$gt": 0}}).sort("openingdate", 1)
+
+def get_settled_trades(symbol: str):
+    """Get the trades of the symbol closed by a settlement, oldest first.
+    """
+    match = {"symbol": symbol, "expired": True}
+    return db.trades.find(match).sort("openingdate", 1)
+
 def get_open_trade_for_symbol(symbol: str):
-    """Get the open trade document for the specified symbol.
+    """Get the oldest open trade document for the specified symbol.
+
+    Served by the partial open_by_symbol index, which only holds open trades.
     """
-    # pick the oldest trade for the symbol which is open
-    match = {"$match": {"symbol": symbol, "openamount": {"$gt": 0}}}
-    sort = {"$sort": {"openingdate": 1 }}
-    limit = {"$limit": 1}
-    pipeline = [match, sort, limit]
-    res = db.trades.aggregate(pipeline)
-    for r in res:
-        return r
+    match = {"symbol": symbol, "openamount": {"$gt": 0}}
+    return db.trades.find_one(match, sort=[("openingdate", 1)])
 
-def close_trade_with_transaction(trade_id, tr):
-    """Update the trade document with information from the closing
-    transaction.
+def get_open_positions(symbol: str = None, underlying: str = None):
+    """Get the open trades, oldest first, optionally for one symbol or
+    underlying.
+
+    Served by the partial open_by_date, open_by_symbol or open_by_underlying
+    index, which only hold open trades.
+    """
+    match = {"openamount": {"$gt": 0}}
+    if symbol:
+        match["symbol"] = symbol
+    if underlying:
+        match["underlying"] = underlying
+    cursor = db_for("get_open_positions").trades.find(match)
+    return list(cursor.sort("openingdate", 1))
+
+def close_trade_update(match, tr):
+    """Build the filter and update closing a trade with a transaction.
+
+    The filter skips trades already listing the transaction, so applying the
+    update twice has no effect.
 
     Parameters
     ----------
-        trade_id : ObjectId of trade
+        match : filter selecting the trade
         tr : transaction document
     """
-    match = {"_id": trade_id}
+    match = dict(match)
+    match["closingtransactions.id"] = {"$ne": tr['id']}
     totalfees = tr['optregfee'] + tr['regfee'] + tr['additionalfee'] + \
         tr['cdscfee'] + tr['othercharges'] + tr['rfee'] + tr['secfee']
     update = {
         "$set": {
-            "closingdate": tr['transactiondate']
+            "closingdate": tr['transactiondate'],
+            "modified": datetime.utcnow(),
         },
         "$inc": {
             "closingprice": tr['cost'],
@@ -239,7 +765,39 @@ def close_trade_with_transaction(trade_id, tr):
             }
         },
     }
-    db.trades.update_one(match, update)
+    return match, update
+
+def settled_amount(trade):
+    """Amount of an expired trade which its settlement closed.
+    """
+    opened = sum(t['amount'] for t in trade['openingtransactions'])
+    return opened - sum(t['amount'] for t in trade['closingtransactions'])
+
+def unsettle_trade_update(match, trade, tr):
+    """Build the filter and update replacing the settlement of an expired
+    trade with a closing transaction, e.g. an assignment imported late.
+
+    The trade is open again for whatever the transaction leaves of the
+    settled amount, the next settlement closes that remainder.
+    """
+    match, update = close_trade_update(match, tr)
+    match["expired"] = True
+    del update["$inc"]["openamount"]
+    update["$set"]["openamount"] = settled_amount(trade) - tr['amount']
+    update["$unset"] = {"expired": ""}
+    return match, update
+
+def close_trade_with_transaction(trade_id, tr):
+    """Update the trade document with information from the closing
+    transaction.
+
+    Parameters
+    ----------
+        trade_id : ObjectId of trade
+        tr : transaction document
+    """
+    match, update = close_trade_update({"_id": trade_id}, tr)
+    trades_collection().update_one(match, update)
     return True
 
 def get_transactions_in_order(field='transactiondate', skip=0, limit=None):
@@ -273,10 +831,14 @@ def mark_processed_transaction_bulk(trans_ids):
     update = {"$set": {"processed": 1}}
     return db.transactions.update_many(match, update)
 
-def update_trades_profits():
+def update_trades_profits(since: datetime = None):
     """Update the profit fields in trades which are 'closed'
+
+    With since only the trades modified since then are updated.
     """
     match = {"openamount" : 0}
+    if since:
+        match["modified"] = {"$gte": since}
     update = [{"$set": {
             "profitdollars": {
                 "$sum": ["$openingprice", "$closingprice"]
@@ -310,9 +872,8 @@ def make_trades_toc():
     project_dates = {"$project": {"year": 1, "month": 1, "_id": 0}}
     group_dates = {"$group": {"_id": {"year": "$year", "month": "$month"}}}
     sort_dates = {"$sort": {"_id.year": 1, "_id.month": 1}}
-    pipeline = [
-        select_dates, split_year_month, project_dates, group_dates, sort_dates
-    ]
+    pipeline = with_archive("trades", [select_dates, split_year_month, project_dates],
+                            [group_dates, sort_dates])
     res = db.trades.aggregate(pipeline)
     flat_list = flatten_dict(list(res), field="_id")
 
@@ -320,19 +881,155 @@ def make_trades_toc():
     db.trades_date_toc.drop()
     # NOTE: insert_many() modifies the passed in parameter.
     to_insert = deepcopy(flat_list)
-    res = db.trades_date_toc.insert_many(to_insert)
+    if to_insert:
+        db.trades_date_toc.insert_many(to_insert)
+    bump_collection_version("trades_date_toc")
     return flat_list
 
+def update_trades_toc(since: datetime):
+    """Add the year and month of trades modified since a date to the table
+    of contents, without rebuilding it.
+
+    Returns
+    -------
+        tuple : number of trades scanned and of entries added.
+    """
+    match = {"$match": {"openingdate": {"$ne": 0}, "modified": {"$gte": since}}}
+    group = {"$group": {"_id": {"year": {"$year": "$openingdate"},
+                                "month": {"$month": "$openingdate"}},
+                        "count": {"$sum": 1}}}
+    months = list(db.trades.aggregate([match, group]))
+    ops = [UpdateOne(m["_id"], {"$setOnInsert": m["_id"]}, upsert=True) for m in months]
+    if not ops:
+        return 0, 0
+    res = db.trades_date_toc.bulk_write(ops, ordered=False)
+    if res.upserted_count:
+        bump_collection_version("trades_date_toc")
+    return sum(m["count"] for m in months), res.upserted_count
+
+def get_trades_toc():
+    """Get the table of contents created by make_trades_toc.
+    """
+    return db_for("get_trades_toc").trades_date_toc.find({}, {"_id": 0}).sort([("year", 1), ("month", 1)])
+
+def get_collection_version(name: str) -> int:
+    """Get the version counter of a collection, used to invalidate payloads
+    derived from it.
+    """
+    res = db.collection_versions.find_one({"_id": name})
+    if res:
+        return res["version"]
+    return 0
+
+def bump_collection_version(name: str):
+    """Increment the version counter of a collection after it was modified.
+    """
+    update = {"$inc": {"version": 1}}
+    return db.collection_versions.update_one({"_id": name}, update, upsert=True)
+
+def ensure_utility_log_indexes():
+    """Index the utility log by type and time, and expire old entries after
+    UTILITY_LOG_TTL_DAYS days.
+    """
+    ttl_seconds = current_app.config.get('UTILITY_LOG_TTL_DAYS', 365) * 24 * 60 * 60
+    db.utilitylog.create_index([("logtype", 1), ("timestamp", -1)])
+    ttl_index = db.utilitylog.index_information().get("timestamp_1")
+    if ttl_index is None:
+        db.utilitylog.create_index("timestamp", expireAfterSeconds=ttl_seconds)
+    elif ttl_index.get("expireAfterSeconds") != ttl_seconds:
+        # create_index can't change the options of an existing index
+        db.command("collMod", "utilitylog",
+                   index={"keyPattern": {"timestamp": 1}, "expireAfterSeconds": ttl_seconds})
+
+def acquire_lock(name: str, owner: str, ttl_seconds: int) -> bool:
+    """Take or extend a named lock for ttl_seconds.
+
+    The lock is a document in the locks collection, an owner holds it until
+    it releases it or the lease expires, e.g. after a crash. The owner can
+    call this again to extend its lease.
+
+    Returns
+    -------
+        bool : whether the lock is now held by owner.
+    """
+    now = datetime.utcnow()
+    match = {"_id": name, "$or": [{"expires": {"$lt": now}}, {"owner": owner}]}
+    update = {"$set": {"owner": owner, "expires": now + timedelta(seconds=ttl_seconds)}}
+    try:
+        db.locks.update_one(match, update, upsert=True)
+    except DuplicateKeyError:
+        return False
+    return True
+
+def release_lock(name: str, owner: str):
+    """Release the lock if it is still held by owner.
+    """
+    db.locks.delete_one({"_id": name, "owner": owner})
+
+def get_watermark(stage: str):
+    """Start time of the last successful run of a pipeline stage, or None.
+    """
+    res = db.pipeline_state.find_one({"_id": stage})
+    if res:
+        return res["watermark"]
+    return None
+
+def set_watermark(stage: str, watermark: datetime):
+    """Record the start time of a successful run of a pipeline stage.
+    """
+    db.pipeline_state.update_one({"_id": stage}, {"$set": {"watermark": watermark}},
+                                 upsert=True)
+
 def add_utility_event(entry):
     """Add the event log entry to the utilitylog collection.
+
+    The entry describes work which is already done, failing to maintain the
+    indexes only logs a warning.
     """
     res = db.utilitylog.insert_one(entry.to_doc())
+    try:
+        ensure_indexes_once(ensure_utility_log_indexes)
+    except PyMongoError as e:
+        current_app.logger.warning("Utility log indexes not updated: %s", e)
     return res
 
+def get_utility_trends(event_type, since: datetime):
+    """Daily duration and throughput figures of a job type since a date.
+    """
+    match = {"$match": {"logtype": event_type, "timestamp": {"$gte": since}}}
+    group = {
+        "$group": {
+            "_id": {"$dateToString": {"format": date_fmt, "date": "$timestamp"}},
+            "runs": {"$sum": 1},
+            "avg_elapsed": {"$avg": "$elapsed"},
+            "max_elapsed": {"$max": "$elapsed"},
+            "avg_throughput": {"$avg": "$throughput"},
+            "scanned": {"$sum": "$scanned"},
+            "inserted": {"$sum": "$inserted"},
+            "updated": {"$sum": "$updated"},
+        }
+    }
+    project = {
+        "$project": {
+            "_id": 0,
+            "day": "$_id",
+            "runs": 1,
+            "avg_elapsed": 1,
+            "max_elapsed": 1,
+            "avg_throughput": 1,
+            "scanned": 1,
+            "inserted": 1,
+            "updated": 1,
+        }
+    }
+    sort = {"$sort": {"day": 1}}
+    res = db_for("get_utility_trends").utilitylog.aggregate([match, group, project, sort])
+    return list(res)
+
 def get_utility_events(event_type, event_count):
     """Fetch a number of events of a certain type.
     """
-    res = db.utilitylog.find({"logtype": event_type}, {"_id": 0}).sort("timestamp", -1).limit(event_count)
+    res = db_for("get_utility_events").utilitylog.find({"logtype": event_type}, {"_id": 0}).sort("timestamp", -1).limit(event_count)
     return res
 
 def get_week_by_date(day):
@@ -346,7 +1043,10 @@ def upsert_week(week: TradingWeek):
     """
     update = week.to_update()
     match = {"start_date": week.start_date} 
-    return db.weeks.update_one(match, update , upsert=True)
+    res = db.weeks.update_one(match, update , upsert=True)
+    if res.modified_count or res.upserted_id:
+        bump_collection_version("weeks")
+    return res
 
 def get_tags_for_week(day):
     """Fetch just the tags for a given week
@@ -355,9 +1055,225 @@ def get_tags_for_week(day):
     project = {"tags": 1, "_id": 0}
     return db.weeks.find_one(match, project)
 
+def add_tag_to_week(day, tag):
+    """Add a single tag to a week document, creating the week if needed.
+
+    Returns the resulting tags.
+    """
+    week = TradingWeek(day)
+    match = {"start_date": day}
+    update = {
+        "$addToSet": {"tags": tag},
+        "$setOnInsert": week.to_set_on_insert(),
+    }
+    before = db.weeks.find_one_and_update(match, update, {"tags": 1, "_id": 0},
+                                          upsert=True)
+    before_tags = before['tags'] if before else []
+    if tag in before_tags:
+        return before_tags, False
+    bump_collection_version("weeks")
+    return before_tags + [tag], True
+
 def delete_tag_from_week(day, tag):
     """Delete a single tag from a week document
     """
     match = {"start_date": day}
     update = {"$pull": { "tags": tag}}
-    return db.weeks.update_one(match, update)
+    res = db.weeks.update_one(match, update)
+    if res.modified_count:
+        bump_collection_version("weeks")
+    return res
+
+# Entity types which can carry tags and memos. Week tags live on the week
+# documents themselves, every other type is tagged in the annotations
+# collection.
+annotation_types = ("trade", "transaction", "day", "week")
+
+def ensure_annotation_indexes():
+    """Create the indexes backing tag and memo lookups.
+    """
+    db.annotations.create_index([("parent_type", 1), ("parent_id", 1)], unique=True)
+    db.annotations.create_index([("tags", 1), ("parent_type", 1)])
+    db.memos.create_index([("parent_type", 1), ("parent_id", 1), ("timestamp", 1)])
+    db.weeks.create_index("tags")
+
+def _tag_operations(entities, update):
+    """Split the per entity updates by the collection holding their tags.
+    """
+    week_ops = []
+    annotation_ops = []
+    for parent_type, parent_id in entities:
+        if parent_type == "week":
+            week_update = dict(update)
+            if "$addToSet" in update:
+                week_update["$setOnInsert"] = TradingWeek(parent_id).to_set_on_insert()
+            week_ops.append(UpdateOne({"start_date": parent_id}, week_update,
+                                      upsert="$addToSet" in update))
+        else:
+            match = {"parent_type": parent_type, "parent_id": parent_id}
+            annotation_ops.append(UpdateOne(match, update, upsert="$addToSet" in update))
+    return week_ops, annotation_ops
+
+def _bulk_tag(entities, update):
+    """Apply a tag update to every entity without reading them first.
+    """
+    week_ops, annotation_ops = _tag_operations(entities, update)
+    counts = {"matched": 0, "modified": 0, "upserted": 0}
+    for collection, ops in ((db.weeks, week_ops), (db.annotations, annotation_ops)):
+        if not ops:
+            continue
+        res = collection.bulk_write(ops, ordered=False)
+        counts["matched"] += res.matched_count
+        counts["modified"] += res.modified_count
+        counts["upserted"] += res.upserted_count
+    if week_ops and (counts["modified"] or counts["upserted"]):
+        bump_collection_version("weeks")
+    return counts
+
+def tag_entities(entities, tags):
+    """Add tags to many entities at once.
+
+    Parameters
+    ----------
+        entities : list of (parent_type, parent_id) tuples
+        tags : list of str
+    """
+    ensure_indexes_once(ensure_annotation_indexes)
+    return _bulk_tag(entities, {"$addToSet": {"tags": {"$each": tags}}})
+
+def untag_entities(entities, tags):
+    """Remove tags from many entities at once.
+
+    Parameters
+    ----------
+        entities : list of (parent_type, parent_id) tuples
+        tags : list of str
+    """
+    return _bulk_tag(entities, {"$pull": {"tags": {"$in": tags}}})
+
+def get_entities_by_tag(tag: str, parent_type: str = None):
+    """Get every entity carrying the tag, through the tags indexes.
+
+    Parameters
+    ----------
+        tag : str
+        parent_type : str Only return entities of this type.
+    """
+    ensure_indexes_once(ensure_annotation_indexes)
+    res = []
+    if parent_type in (None, "week"):
+        weeks = db_for("get_entities_by_tag").weeks.find({"tags": tag}, {"start_date": 1, "_id": 0})
+        res.extend({"parent_type": "week", "parent_id": w["start_date"]} for w in weeks)
+    if parent_type != "week":
+        match = {"tags": tag}
+        if parent_type:
+            match["parent_type"] = parent_type
+        project = {"parent_type": 1, "parent_id": 1, "_id": 0}
+        res.extend(db_for("get_entities_by_tag").annotations.find(match, project))
+    return res
+
+def get_annotation(parent_type: str, parent_id):
+    """Get the tags and memos attached to one entity.
+    """
+    if parent_type == "week":
+        tags = get_tags_for_week(parent_id)
+    else:
+        match = {"parent_type": parent_type, "parent_id": parent_id}
+        tags = db.annotations.find_one(match, {"tags": 1, "_id": 0})
+    return {
+        "parent_type": parent_type,
+        "parent_id": parent_id,
+        "tags": (tags or {}).get("tags", []),
+        "memos": list(get_memos(parent_type, parent_id)),
+    }
+
+def add_memo(memo: Memo):
+    """Insert a memo document
+    """
+    return db.memos.insert_one(memo.to_doc())
+
+def get_memos(parent_type: str, parent_id):
+    """Get the memos attached to one entity, oldest first.
+    """
+    match = {"parent_type": parent_type, "parent_id": parent_id}
+    return db.memos.find(match).sort("timestamp", 1)
+
+def delete_memo(parent_type: str, parent_id, memo_id: str):
+    """Delete a memo of an entity by its ObjectId.
+    """
+    try:
+        memo_id = ObjectId(memo_id)
+    except InvalidId:
+        return None
+    match = {"_id": memo_id, "parent_type": parent_type, "parent_id": parent_id}
+    return db.memos.delete_one(match)
+
+def ensure_ohlc_collection():
+    """Create the ohlc time-series collection and its index if missing.
+    """
+    if "ohlc" not in db.list_collection_names(filter={"name": "ohlc"}):
+        timeseries = {
+            "timeField": "timestamp",
+            "metaField": "symbol",
+            "granularity": "minutes",
+        }
+        db.create_collection("ohlc", timeseries=timeseries)
+    db.ohlc.create_index([("symbol", 1), ("timestamp", 1)])
+
+def insert_ohlc_bars(bars):
+    """Insert a batch of OHLC bar documents.
+    """
+    return db.ohlc.insert_many(bars, ordered=False)
+
+def get_ohlc_bars(symbol: str, start: datetime, end: datetime):
+    """Get the bars of a symbol between start and end, in time order.
+    """
+    match = {"symbol": symbol, "timestamp": {"$gte": start, "$lte": end}}
+    return db_for("get_ohlc_bars").ohlc.find(match, {"_id": 0}).sort("timestamp", 1)
+
+def ensure_archive_collections():
+    """Create the zstd compressed archive collections and their indexes.
+    """
+    existing = db.list_collection_names()
+    storage = {"wiredTiger": {"configString": "block_compressor=zstd"}}
+    for collection in ("trades", "transactions"):
+        if archive_name(collection) not in existing:
+            db.create_collection(archive_name(collection), storageEngine=storage)
+    db.transactions_archive.create_index("id", unique=True)
+    db.trades_archive.create_index("closingdate")
+    db.trades_archive.create_index("symbol")
+
+def _archive(collection: str, match: dict, batch_size: int):
+    """Move the documents matching match into the archive, in batches.
+
+    Documents keep their _id, so a rerun after a partial failure only
+    deletes what is already archived.
+    """
+    source = db[collection]
+    target = db[archive_name(collection)]
+    moved = 0
+    while True:
+        batch = list(source.find(match).limit(batch_size))
+        if not batch:
+            break
+        try:
+            target.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # duplicates were archived by an earlier, interrupted run
+            if any(err['code'] != 11000 for err in e.details['writeErrors']):
+                raise
+        source.delete_many({"_id": {"$in": [d["_id"] for d in batch]}})
+        moved += len(batch)
+    return moved
+
+def archive_transactions(cutoff: datetime, batch_size: int = 1000):
+    """Move processed transactions older than cutoff to the archive.
+    """
+    match = {"processed": 1, "transactiondate": {"$lt": cutoff}}
+    return _archive("transactions", match, batch_size)
+
+def archive_trades(cutoff: datetime, batch_size: int = 1000):
+    """Move fully closed trades closed before cutoff to the archive.
+    """
+    match = {"openamount": 0, "closingdate": {"$ne": 0, "$lt": cutoff}}
+    return _archive("trades", match, batch_size)
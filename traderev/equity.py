@@ -0,0 +1,84 @@
+"""Equity curve and rolling performance series over closed trades.
+
+The series are kept per worker process and extended with trades closed since
+the last refresh instead of being recomputed on every request.
+"""
+import threading
+import pandas as pd
+from traderev import db
+from traderev.analytics import compute_equity_curve, compute_rolling_stats
+
+# Limit how many distinct rolling windows are kept around.
+max_cached_windows = 8
+
+class TradeSeries():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Drop everything computed so far.
+        """
+        self.frame = pd.DataFrame(
+            columns=['closingdate', 'pnl', 'cumulative_pnl', 'peak', 'drawdown'])
+        self.windows = {}
+
+    @property
+    def watermark(self):
+        """Closing date of the most recent trade in the series.
+        """
+        if self.frame.empty:
+            return None
+        return pd.Timestamp(self.frame['closingdate'].iloc[-1]).to_pydatetime()
+
+    def refresh(self):
+        """Extend the equity curve with trades closed since the watermark.
+
+        A trade may be fully closed after newer trades were already picked up,
+        in that case the closed trade count up to the watermark no longer
+        matches and the series is rebuilt.
+        """
+        with self.lock:
+            watermark = self.watermark
+            if watermark is not None and \
+                    db.count_closed_trades(watermark) != len(self.frame):
+                self.reset()
+                watermark = None
+            new_trades = pd.DataFrame(db.get_closed_trades_pnl(watermark))
+            if new_trades.empty:
+                return self.frame
+            start_pnl, start_peak = 0, 0
+            if not self.frame.empty:
+                start_pnl = self.frame['cumulative_pnl'].iloc[-1]
+                start_peak = self.frame['peak'].iloc[-1]
+            curve = compute_equity_curve(new_trades['pnl'], start_pnl, start_peak)
+            new_rows = pd.concat([new_trades, curve], axis=1)
+            if self.frame.empty:
+                self.frame = new_rows
+            else:
+                self.frame = pd.concat([self.frame, new_rows], ignore_index=True)
+            return self.frame
+
+    def rolling(self, window: int):
+        """Return rolling stats for the given window, aligned with the equity
+        curve. Only the rows added since the last call are computed.
+        """
+        frame = self.refresh()
+        with self.lock:
+            cached = self.windows.get(window)
+            done = 0 if cached is None else len(cached)
+            if done == len(frame):
+                return cached
+            # the new rows need the preceding window - 1 trades as context
+            start = max(0, done - window + 1)
+            stats = compute_rolling_stats(frame['pnl'].iloc[start:], window)
+            stats = stats.iloc[done - start:]
+            if cached is not None:
+                stats = pd.concat([cached, stats])
+            elif len(self.windows) >= max_cached_windows:
+                self.windows.pop(next(iter(self.windows)))
+            self.windows[window] = stats
+            return stats
+
+trade_series = TradeSeries()
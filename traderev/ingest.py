@@ -0,0 +1,116 @@
+"""Ingest of OHLC market data, in bulk and by stream.
+
+Records are read line by line from the request body and inserted in
+batches, so memory use is bounded by the batch size rather than the size of
+the upload.
+"""
+import csv
+import json
+import time
+from pymongo.errors import BulkWriteError
+from traderev import db
+from traderev.schemas import ohlc_bar_doc
+
+default_batch_size = 1000
+
+def iter_records(lines, fmt: str):
+    """Decode records from an iterable of raw lines.
+
+    Parameters
+    ----------
+        lines : iterable of bytes
+        fmt : str Either 'ndjson' or 'csv', csv input needs a header row.
+
+    Yields dictionaries, or None for lines which could not be decoded.
+    """
+    if fmt == 'csv':
+        undecodable = []
+        text = utf8_lines(lines, undecodable)
+        for row in csv.DictReader(text):
+            # lines skipped while reading this row
+            while undecodable:
+                yield undecodable.pop()
+            yield row
+        while undecodable:
+            yield undecodable.pop()
+        return
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line.decode('utf-8'))
+        except ValueError:
+            yield None
+
+def utf8_lines(lines, undecodable: list):
+    """Decode lines as UTF-8, appending None to undecodable for every line
+    which isn't valid UTF-8 instead of failing the whole upload.
+    """
+    for line in lines:
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError:
+            undecodable.append(None)
+
+class BarWriter():
+    """Collects bars and inserts them in batches.
+    """
+
+    def __init__(self, batch_size: int = default_batch_size, flush_seconds: float = None):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.batch = []
+        self.last_flush = time.monotonic()
+        self.inserted = 0
+        self.rejected = 0
+        self.batches = 0
+
+    def add(self, record):
+        try:
+            self.batch.append(ohlc_bar_doc(record))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            self.rejected += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        elif self.flush_seconds is not None and \
+                time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.batch:
+            return
+        try:
+            res = db.insert_ohlc_bars(self.batch)
+            self.inserted += len(res.inserted_ids)
+        except BulkWriteError as e:
+            self.inserted += e.details['nInserted']
+            self.rejected += len(e.details['writeErrors'])
+        self.batches += 1
+        self.batch = []
+
+    def summary(self):
+        return {
+            'inserted': self.inserted,
+            'rejected': self.rejected,
+            'batches': self.batches,
+        }
+
+def ingest(lines, fmt: str, batch_size: int = default_batch_size,
+           flush_seconds: float = None):
+    """Insert every bar read from lines, returns the ingest summary.
+
+    Parameters
+    ----------
+        lines : iterable of bytes
+        fmt : str Either 'ndjson' or 'csv'.
+        batch_size : int Number of bars per insert.
+        flush_seconds : float Insert a partial batch once it is this old,
+            used for streams so bars become visible promptly.
+    """
+    db.ensure_ohlc_collection()
+    writer = BarWriter(batch_size, flush_seconds)
+    for record in iter_records(lines, fmt):
+        writer.add(record)
+    writer.flush()
+    return writer.summary()
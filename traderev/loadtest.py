@@ -0,0 +1,363 @@
+"""Load testing of the gunicorn deployment, reports latency and throughput
+for each combination of worker class and worker count.
+
+Every run launches the app with gunicorn, using the settings of launcher.sh
+apart from the worker class and count, or the ASGI app with hypercorn for
+the 'asgi' worker class, against a MongoDB database seeded
+with synthetic transactions and the trades built from them. Virtual users
+replay a weighted mix of trade,
+stats, week and rebuild requests over keep-alive connections for a fixed
+duration.
+"""
+import asyncio
+import math
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from traderev.utils import date_fmt
+
+default_mongo_uri = "mongodb://localhost:27017/traderev_loadtest"
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Weighted request mix as (weight, name, method, path), paths are formatted
+# with a random day, week and year of the seeded data.
+scenario = [
+    (20, "trades", "GET", "/api/trades?n=50"),
+    (5, "trades all", "GET", "/api/trades"),
+    (15, "stats trades", "GET", "/api/stats/trades?n=100"),
+    (10, "stats daily", "GET", "/api/stats/daily?day={day}"),
+    (10, "stats weekly", "GET", "/api/stats/weekly?week={week}"),
+    (5, "stats breakdown", "GET", "/api/stats/breakdown?by=underlying,putcall"),
+    (5, "stats equity", "GET", "/api/stats/equity"),
+    (5, "stats rolling", "GET", "/api/stats/rolling?window=20"),
+    (10, "weeks", "GET", "/api/weeks/{week}"),
+    (10, "weeks yearly", "GET", "/api/weeks/yearly?year={year}"),
+    (4, "rebuild dry run", "POST", "/api/trades?dry_run=true"),
+    (1, "rebuild", "POST", "/api/trades"),
+]
+
+# Endpoints served by both the WSGI and the ASGI app, to compare the gevent
+# deployment with hypercorn. Stats are computed by mongodb in both apps.
+dashboard_scenario = [
+    (30, "dashboard", "GET", "/api/dashboard?week={week}"),
+    (20, "trades", "GET", "/api/trades?n=50"),
+    (15, "stats daily", "GET", "/api/stats/daily?day={day}&engine=mongo"),
+    (15, "stats weekly", "GET", "/api/stats/weekly?week={week}&engine=mongo"),
+    (20, "weeks", "GET", "/api/weeks/{week}"),
+]
+
+scenarios = {"full": scenario, "dashboard": dashboard_scenario}
+
+launcher_args = ["--timeout", "5", "--keep-alive", "5", "--max-requests", "1000",
+                 "--log-level", "warning"]
+
+def synthetic_transactions(days: int, per_day: int, start: datetime):
+    """Opening and closing option transactions, most positions are closed a
+    few days after being opened.
+    """
+    rng = random.Random(42)
+    fees = {"optregfee": 0.02, "regfee": 0.0, "additionalfee": 0.0,
+            "cdscfee": 0.0, "othercharges": 0.0, "rfee": 0.0, "secfee": 0.01}
+    trans_id = 1
+    for day in range(days):
+        opened = start + timedelta(days=day, hours=14)
+        if opened.weekday() > 4:
+            continue
+        for i in range(per_day):
+            underlying = rng.choice(["SPY", "QQQ", "IWM", "AAPL", "TSLA"])
+            putcall = rng.choice(["PUT", "CALL"])
+            symbol = f"{underlying}_{opened:%m%d%y}{putcall[0]}{i}"
+            amount = float(rng.randint(1, 5))
+            cost = -amount * rng.randint(20, 300)
+            common = {"symbol": symbol, "underlying": underlying, "putcall": putcall,
+                      "amount": amount, "commission": 0.65 * amount, **fees}
+            yield {**common, "id": trans_id, "positioneffect": "OPENING", "cost": cost,
+                   "transactiondate": opened}
+            trans_id += 1
+            closed = opened + timedelta(days=rng.randint(0, 4), hours=rng.randint(0, 5))
+            if closed >= datetime.utcnow() or rng.random() < 0.1:
+                continue
+            yield {**common, "id": trans_id, "positioneffect": "CLOSING",
+                   "cost": -cost + rng.randint(-150, 150),
+                   "transactiondate": closed}
+            trans_id += 1
+
+def seed_database(mongo_uri: str, days: int, per_day: int):
+    """Replace the contents of the load test database with synthetic
+    transactions.
+
+    Returns
+    -------
+        datetime : date of the first seeded day.
+    """
+    from pymongo import MongoClient
+    client = MongoClient(mongo_uri)
+    database = client.get_default_database()
+    if database.name == "traderev":
+        raise ValueError("Refusing to seed the 'traderev' database")
+    client.drop_database(database.name)
+    start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) \
+        - timedelta(days=days)
+    database.transactions.insert_many(list(synthetic_transactions(days, per_day, start)))
+    client.close()
+    return start
+
+def build_trades():
+    """Build the trades of the seeded transactions with the app's rebuild
+    code, in this process so no worker timeout can cut it short.
+
+    Must run in an app context. Returns the number of trades.
+    """
+    from traderev import db, trades
+    db.ensure_trade_indexes()
+    db.ensure_transaction_indexes()
+    trades.apply_plan(trades.plan_trades())
+    db.update_trades_profits()
+    count = db.db.trades.count_documents({})
+    if not count:
+        raise RuntimeError("No trades were built from the seeded transactions")
+    return count
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def launch(worker_class: str, workers: int, port: int, mongo_ini: str):
+    """Start gunicorn serving wsgi:app, or hypercorn serving asgi:app for the
+    'asgi' worker class, and wait until it accepts connections.
+    """
+    if worker_class == "asgi":
+        cmd = [sys.executable, "-m", "hypercorn", "--workers", str(workers),
+               "--bind", f"127.0.0.1:{port}", "--keep-alive", "5", "asgi:app"]
+    else:
+        cmd = [sys.executable, "-m", "gunicorn", "--worker-class", worker_class,
+               "--workers", str(workers), "--bind", f"127.0.0.1:{port}",
+               *launcher_args, "wsgi:app"]
+    env = dict(os.environ, MONGO_INI=mongo_ini)
+    proc = subprocess.Popen(cmd, env=env, cwd=repo_root)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{cmd[2]} exited with code {proc.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    stop(proc)
+    raise RuntimeError(f"{cmd[2]} did not start within 30s")
+
+def stop(proc):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+class Connection():
+    """A minimal HTTP/1.1 keep-alive client connection.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+
+    async def request(self, method: str, path: str):
+        """Send a request and read the whole response, reconnecting once if
+        the server closed the connection, e.g. on a worker restart.
+
+        Returns the status code.
+        """
+        for attempt in range(2):
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                return await self._request(method, path)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                await self.close()
+                if attempt:
+                    raise
+
+    async def _request(self, method: str, path: str):
+        self.writer.write((f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                           "Accept-Encoding: gzip, br\r\nContent-Length: 0\r\n\r\n").encode())
+        await self.writer.drain()
+        status_line = await self.reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding") == "chunked":
+            while True:
+                size = int((await self.reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        elif "content-length" in headers:
+            await self.reader.readexactly(int(headers["content-length"]))
+        else:
+            await self.reader.read()
+            await self.close()
+        if headers.get("connection", "").lower() == "close":
+            await self.close()
+        return status
+
+def scenario_paths(mix, start: datetime, days: int, rng: random.Random):
+    """Endless (name, method, path) requests drawn from a scenario mix.
+    """
+    weights = [w for w, *_ in mix]
+    while True:
+        _, name, method, path = rng.choices(mix, weights)[0]
+        day = start + timedelta(days=rng.randrange(days))
+        monday = day - timedelta(days=day.weekday())
+        yield name, method, path.format(day=day.strftime(date_fmt),
+                                        week=monday.strftime(date_fmt), year=day.year)
+
+async def virtual_user(host, port, requests, deadline, results):
+    conn = Connection(host, port)
+    try:
+        for name, method, path in requests:
+            if time.monotonic() >= deadline:
+                break
+            start = time.perf_counter()
+            try:
+                status = await conn.request(method, path)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                status = None
+            results.append((name, time.perf_counter() - start, status))
+    finally:
+        await conn.close()
+
+async def run_load(base_url: str, users: int, duration: float,
+                   start: datetime, days: int, seed: int = 0, mix=scenario):
+    """Replay a scenario with concurrent virtual users for duration seconds.
+
+    Returns
+    -------
+        tuple : list of (name, latency in seconds, status or None on a
+            connection error) and the elapsed wall time.
+    """
+    url = urlsplit(base_url)
+    results = []
+    deadline = time.monotonic() + duration
+    began = time.perf_counter()
+    await asyncio.gather(*(
+        virtual_user(url.hostname, url.port or 80,
+                     scenario_paths(mix, start, days, random.Random(seed + i)),
+                     deadline, results)
+        for i in range(users)))
+    return results, time.perf_counter() - began
+
+def percentile(values, q: float):
+    """Nearest rank percentile of already sorted values.
+    """
+    if not values:
+        return None
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return values[rank - 1]
+
+def summarize(results, elapsed: float):
+    """Request count, errors, 404s, p50/p99 latency in ms and requests per
+    second, overall and for each request name.
+
+    Statuses of 5xx and connection errors count as errors. A few 404s on
+    days without trades are expected, most requests returning 404 means
+    the seeded data is not being served.
+    """
+    groups = {"all": results}
+    for row in results:
+        groups.setdefault(row[0], []).append(row)
+    summary = {}
+    for name, rows in groups.items():
+        latencies = sorted(latency * 1000 for _, latency, _ in rows)
+        summary[name] = {
+            "requests": len(rows),
+            "errors": sum(1 for *_, status in rows if status is None or status >= 500),
+            "not_found": sum(1 for *_, status in rows if status == 404),
+            "p50_ms": percentile(latencies, 50),
+            "p99_ms": percentile(latencies, 99),
+            "rps": len(rows) / elapsed if elapsed else 0,
+        }
+    return summary
+
+def format_report(rows, by_endpoint: bool = False):
+    """Capacity report as a markdown table, one line per worker class and count.
+    """
+    lines = ["| worker class | workers | endpoint | requests | errors | 404s | p50 ms | p99 ms | req/s |",
+             "|---|---|---|---|---|---|---|---|---|"]
+    for worker_class, workers, summary in rows:
+        names = summary if by_endpoint else ["all"]
+        for name in names:
+            s = summary[name]
+            lines.append(f"| {worker_class} | {workers} | {name} | {s['requests']} | "
+                         f"{s['errors']} | {s['not_found']} | {s['p50_ms']:.1f} | {s['p99_ms']:.1f} | "
+                         f"{s['rps']:.1f} |")
+    return "\n".join(lines)
+
+async def measure(port: int, start: datetime, args):
+    """Warm up every worker, then measure.
+    """
+    base_url = f"http://127.0.0.1:{port}"
+    mix = scenarios[args.scenario]
+    await run_load(base_url, args.users, args.warmup, start, args.days, mix=mix)
+    return await run_load(base_url, args.users, args.duration, start, args.days, mix=mix)
+
+def main(args):
+    """Seed the database, then load test every worker class and count.
+    """
+    if "asgi" in args.worker_class and args.scenario != "dashboard":
+        print("The asgi worker class only serves the dashboard scenario")
+        return 2
+    mongo_ini = tempfile.NamedTemporaryFile("w", suffix=".ini", delete=False)
+    with mongo_ini:
+        mongo_ini.write(f"[default]\nmongo_uri={args.mongo_uri}\n")
+    try:
+        start = seed_database(args.mongo_uri, args.days, args.per_day)
+        os.environ['MONGO_INI'] = mongo_ini.name
+        from traderev import create_app
+        with create_app().app_context():
+            count = build_trades()
+        print(f"Seeded {args.days} days of transactions and {count} trades into {args.mongo_uri}")
+        rows = []
+        for worker_class in args.worker_class:
+            for workers in args.workers:
+                port = free_port()
+                proc = launch(worker_class, workers, port, mongo_ini.name)
+                try:
+                    results, elapsed = asyncio.run(measure(port, start, args))
+                finally:
+                    stop(proc)
+                summary = summarize(results, elapsed)
+                rows.append((worker_class, workers, summary))
+                total = summary['all']
+                print(f"{worker_class} x{workers}: {total['rps']:.1f} req/s, "
+                      f"p99 {total['p99_ms']:.1f} ms, {total['errors']} errors, "
+                      f"{total['not_found']} 404s")
+        print(format_report(rows, args.by_endpoint))
+    finally:
+        os.unlink(mongo_ini.name)
+    return 0
@@ -0,0 +1,111 @@
+"""The batch job pipeline: trade build, settlement of expired options,
+profits and the trades table of contents, run in that order.
+
+Each stage only processes what changed since its watermark, the start time
+of its last successful run, and records its timing in the utility log. A
+lock document keeps two processes, e.g. the scheduler and a gunicorn worker,
+from running the pipeline at the same time.
+"""
+import os
+import socket
+import time
+from datetime import datetime
+from uuid import uuid4
+from flask import current_app
+from traderev import db, trades
+from traderev.schemas import LogEntryType, UtilityLogEntry
+
+lock_name = "pipeline"
+default_lock_seconds = 600
+
+def build_trades(since):
+    """Build trades from the transactions not processed yet.
+
+    The processed flag is the delta of this stage: transactions which ended
+    up in a trade are marked, unmatched closing transactions stay pending
+    and are retried on the next run.
+    """
+    db.ensure_trade_indexes()
+    db.ensure_transaction_indexes()
+    plan = trades.plan_trades(pending=True)
+    for tr in plan["unmatched"]:
+        current_app.logger.info("No open trade found for this closing transaction: %s", tr['id'])
+    inserted, updated = trades.apply_plan(plan)
+    ids = trades.processed_ids(plan)
+    if ids:
+        db.mark_processed_transaction_bulk(ids)
+    return {"scanned": sum(trades.plan_summary(plan).values()),
+            "inserted": inserted, "updated": updated}
+
+def settle_trades(since):
+    """Close the trades of options which expired SETTLEMENT_GRACE_DAYS
+    before today.
+    """
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    grace_days = current_app.config.get('SETTLEMENT_GRACE_DAYS', trades.default_grace_days)
+    scanned, updated = trades.settle_expired_trades(today, grace_days)
+    return {"scanned": scanned, "updated": updated}
+
+def update_profits(since):
+    """Compute the profits of trades closed or settled since the watermark.
+    """
+    res = db.update_trades_profits(since)
+    return {"scanned": res.matched_count, "updated": res.modified_count}
+
+def update_toc(since):
+    """Add the months of trades modified since the watermark to the table of
+    contents, the first run builds it from scratch.
+    """
+    if since is None:
+        res = db.make_trades_toc()
+        return {"scanned": len(res), "inserted": len(res)}
+    scanned, inserted = db.update_trades_toc(since)
+    return {"scanned": scanned, "inserted": inserted}
+
+# (name, log entry type, stage function) in dependency order
+stages = [
+    ("trades", LogEntryType.Trades, build_trades),
+    ("settlement", LogEntryType.Settlement, settle_trades),
+    ("profits", LogEntryType.Profits, update_profits),
+    ("toc", LogEntryType.Toc, update_toc),
+]
+
+def run_pipeline(author: str = "scheduler"):
+    """Run every stage in order, stopping at the first failure.
+
+    A failed stage keeps its watermark, so the next run picks up its delta
+    again.
+
+    Returns
+    -------
+        dict : counts of each stage, or None when another process holds the
+            pipeline lock.
+    """
+    # unique per run, gevent workers serve concurrent requests in one process
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex}"
+    ttl = current_app.config.get('PIPELINE_LOCK_SECONDS', default_lock_seconds)
+    if not db.acquire_lock(lock_name, owner, ttl):
+        return None
+    results = {}
+    try:
+        for name, logtype, stage in stages:
+            # extends the lease before every stage
+            if not db.acquire_lock(lock_name, owner, ttl):
+                raise RuntimeError("Pipeline lock lost")
+            started = datetime.utcnow()
+            start_time = time.time()
+            counts = stage(db.get_watermark(name))
+            elapsed_time = time.time() - start_time
+            message = [f"{k.capitalize()} {v}" for k, v in counts.items()]
+            message.append(f"Elapsed {elapsed_time:.2f}s")
+            db.add_utility_event(UtilityLogEntry(logtype=logtype,
+                                                 timestamp=started,
+                                                 author=author,
+                                                 message=message,
+                                                 elapsed=elapsed_time,
+                                                 **counts))
+            db.set_watermark(name, started)
+            results[name] = counts
+    finally:
+        db.release_lock(lock_name, owner)
+    return results
@@ -0,0 +1,107 @@
+"""Runs the batch job pipeline on a cron-like schedule.
+
+Schedules use the five cron fields: minute, hour, day of month, month and
+day of week (0 or 7 is Sunday). Fields accept `*`, values, ranges `a-b`,
+steps `*/n` or `a-b/n` and comma separated lists.
+"""
+import time
+from datetime import datetime, timedelta
+
+default_schedule = "*/15 * * * *"
+
+# (lowest, highest) value of each field
+field_ranges = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+def parse_field(field: str, low: int, high: int):
+    """Parse one cron field into the set of values it matches.
+    """
+    values = set()
+    for part in field.split(","):
+        span, _, step = part.partition("/")
+        step = int(step) if step else 1
+        if span == "*":
+            start, end = low, high
+        elif "-" in span:
+            start, end = (int(v) for v in span.split("-"))
+        else:
+            start = end = int(span)
+            if step > 1:
+                end = high
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"Invalid cron field: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+def parse_schedule(schedule: str):
+    """Parse a five field cron expression.
+
+    Returns
+    -------
+        tuple : minutes, hours, days of month, months and days of week sets,
+            followed by whether the day of month and day of week fields are
+            restricted.
+    """
+    fields = schedule.split()
+    if len(fields) != 5:
+        raise ValueError(f"Expected five cron fields: {schedule}")
+    minutes, hours, days, months, weekdays = (
+        parse_field(f, *r) for f, r in zip(fields, field_ranges))
+    if 7 in weekdays:
+        weekdays.add(0)
+    return minutes, hours, days, months, weekdays, fields[2] != "*", fields[4] != "*"
+
+def day_matches(parsed, day: datetime):
+    _, _, days, months, weekdays, days_set, weekdays_set = parsed
+    if day.month not in months:
+        return False
+    in_days = day.day in days
+    # cron weekdays start on Sunday
+    in_weekdays = (day.weekday() + 1) % 7 in weekdays
+    if days_set and weekdays_set:
+        return in_days or in_weekdays
+    return in_days and in_weekdays
+
+def next_run(parsed, after: datetime):
+    """First minute after the given time matching the parsed schedule.
+    """
+    minutes, hours = parsed[0], parsed[1]
+    t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = t + timedelta(days=366 * 5)
+    while t < limit:
+        if not day_matches(parsed, t):
+            t = t.replace(hour=0, minute=0) + timedelta(days=1)
+        elif t.hour not in hours:
+            t = t.replace(minute=0) + timedelta(hours=1)
+        elif t.minute not in minutes:
+            t += timedelta(minutes=1)
+        else:
+            return t
+    raise ValueError("Schedule never matches")
+
+def main(args):
+    """Run the pipeline on schedule, or once with --once.
+    """
+    from traderev import create_app
+    from traderev.pipeline import run_pipeline
+    app = create_app()
+    parsed = parse_schedule(args.schedule or
+                            app.config.get('PIPELINE_SCHEDULE', default_schedule))
+    while True:
+        if not args.once:
+            run_at = next_run(parsed, datetime.now())
+            app.logger.info("Next pipeline run at %s", run_at)
+            time.sleep(max(0, (run_at - datetime.now()).total_seconds()))
+        with app.app_context():
+            try:
+                res = run_pipeline()
+            except Exception:
+                app.logger.exception("Pipeline run failed")
+                if args.once:
+                    return 1
+                continue
+        if res is None:
+            app.logger.warning("Pipeline is already running elsewhere, skipped")
+        else:
+            app.logger.info("Pipeline run: %s", res)
+        if args.once:
+            return 0
@@ -1,7 +1,7 @@
 """Some document collections will have a strict structure.
 """
 import json
-from datetime import timedelta
+from datetime import timedelta, timezone
 from enum import Enum
 from datetime import datetime
 from .utils import date_fmt
@@ -10,21 +10,45 @@ class LogEntryType(Enum):
     Import = "Import" # import of transactions
     Profits = "Profits" # Update of profits
     Trades = "Trades" # Creation or update of trades
+    Archive = "Archive" # Move of old documents to the archive collections
+    Settlement = "Settlement" # Close of trades with expired options
+    Toc = "Toc" # Update of the trades table of contents
 
 class UtilityLogEntry():
 
-    def __init__(self, logtype: LogEntryType, timestamp: datetime = None, message: str = None, author: str = None ):
+    def __init__(self, logtype: LogEntryType, timestamp: datetime = None, message: str = None, author: str = None,
+                 scanned: int = None, inserted: int = None, updated: int = None, elapsed: float = None):
         """
         Parameters:
         logtype (LogEntryType): One of the enumerated log entry types.
         timestamp (datetime): Timestamp of the event.
         message (str): Arbitrary message describing the event.
         author (str): Identifier of the person or system that initiated the event.
+        scanned (int): Number of documents the job read.
+        inserted (int): Number of documents the job inserted.
+        updated (int): Number of documents the job updated.
+        elapsed (float): Duration of the job in seconds.
         """
         self.logtype = logtype
         self.timestamp = timestamp or datetime.utcnow()
         self.author = author
         self.message = message
+        self.scanned = scanned
+        self.inserted = inserted
+        self.updated = updated
+        self.elapsed = elapsed
+
+    @property
+    def throughput(self):
+        """Documents processed per second, scanned when known, otherwise
+        written.
+        """
+        if not self.elapsed:
+            return None
+        processed = self.scanned
+        if processed is None:
+            processed = (self.inserted or 0) + (self.updated or 0)
+        return processed / self.elapsed
 
     def to_doc(self):
         """Build the document object.
@@ -33,10 +57,74 @@ class UtilityLogEntry():
             'logtype': self.logtype.value,
             'timestamp': self.timestamp,
             'author': self.author,
-            'message': self.message
+            'message': self.message,
+            'scanned': self.scanned,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'elapsed': self.elapsed,
+            'throughput': self.throughput,
+        }
+
+
+class Memo():
+
+    def __init__(self, parent_type: str, parent_id, text: str, timestamp: datetime = None):
+        """
+        Parameters:
+        parent_type (str): One of the annotation types, such as 'trade' or 'week'.
+        parent_id: Identifier of the annotated entity.
+        text (str): The memo itself.
+        timestamp (datetime): Time the memo was written.
+        """
+        self.parent_type = parent_type
+        self.parent_id = parent_id
+        self.text = text
+        self.timestamp = timestamp or datetime.utcnow()
+
+    def to_doc(self):
+        """Build the document object.
+        """
+        return {
+            'parent_type': self.parent_type,
+            'parent_id': self.parent_id,
+            'timestamp': self.timestamp,
+            'text': self.text,
         }
 
 
+def parse_timestamp(value) -> datetime:
+    """Parse an ISO 8601 string or epoch seconds into a naive UTC datetime.
+    """
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None)
+    value = value.strip()
+    try:
+        return datetime.fromtimestamp(float(value), timezone.utc).replace(tzinfo=None)
+    except ValueError:
+        pass
+    ts = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+def ohlc_bar_doc(record: dict):
+    """Build an OHLC bar document from an ingested record.
+
+    Raises ValueError or KeyError for malformed records.
+    """
+    doc = {
+        'symbol': str(record['symbol']),
+        'timestamp': parse_timestamp(record['timestamp']),
+        'open': float(record['open']),
+        'high': float(record['high']),
+        'low': float(record['low']),
+        'close': float(record['close']),
+        'volume': float(record.get('volume') or 0),
+    }
+    if not doc['symbol']:
+        raise ValueError("Empty symbol")
+    return doc
+
 def get_dates_between(start, end):
     """Generate a list of dates between two dates, including start and end.
     """
@@ -87,6 +175,16 @@ class TradingWeek():
         self.memos = d['memos']
         self.weekdays = d['weekdays']
 
+    def to_set_on_insert(self):
+        """Return the fields to set when a tag update creates the document.
+        Tags are left out since the update itself manages them.
+        """
+        return {
+            'end_date': self.end_date,
+            'memos': self.memos,
+            'weekdays': self.weekdays,
+        }
+
     def to_update(self):
         """Return an update document
         """
@@ -0,0 +1,73 @@
+"""Startup profiling, reports how long a cold worker takes to import the
+app and run the factory.
+"""
+import os
+import subprocess
+import sys
+
+# Modules which must only be imported once stats are requested.
+lazy_modules = ("pandas", "numpy")
+
+# Imports the app and times create_app() in a fresh interpreter, then lists
+# the lazy modules it imported anyway.
+profile_script = """
+import sys
+import time
+start = time.perf_counter()
+from traderev import create_app
+create_app()
+print(f"create_app {(time.perf_counter() - start) * 1000:.1f}")
+print("loaded", *(m for m in %r if m in sys.modules))
+""" % (lazy_modules,)
+
+def parse_importtime(output: str):
+    """Parse `-X importtime` output into (module, self_us, cumulative_us) tuples.
+    """
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        # nested imports are indented below the module importing them
+        rows.append((fields[2][1:].rstrip(), int(fields[0]), int(fields[1])))
+    return rows
+
+def startup_profile(top: int = 15):
+    """Profile a cold create_app() in a subprocess.
+
+    Returns
+    -------
+        tuple : create_app wall time in ms, total import time in ms, the
+            slowest modules as (module, self_us) tuples and the lazy modules
+            which were imported.
+    """
+    cmd = [sys.executable, "-X", "importtime", "-c", profile_script]
+    res = subprocess.run(cmd, capture_output=True, text=True, env=os.environ.copy())
+    if res.returncode != 0:
+        raise RuntimeError(res.stderr or res.stdout)
+    timing, loaded = res.stdout.splitlines()[-2:]
+    elapsed_ms = float(timing.split()[-1])
+    loaded = loaded.split()[1:]
+    rows = parse_importtime(res.stderr)
+    total_ms = sum(self_us for _, self_us, _ in rows) / 1000
+    slowest = sorted(((m.strip(), self_us) for m, self_us, _ in rows),
+                     key=lambda r: r[1], reverse=True)[:top]
+    return elapsed_ms, total_ms, slowest, loaded
+
+def main(args):
+    """Print the startup profile, fail if create_app() imported pandas or numpy
+    or exceeded --max-ms.
+    """
+    elapsed_ms, total_ms, slowest, loaded = startup_profile(args.top)
+    print(f"create_app(): {elapsed_ms:.1f} ms")
+    print(f"Total import time: {total_ms:.1f} ms")
+    print("Slowest modules (excluding their own imports):")
+    for module, self_us in slowest:
+        print(f"  {self_us / 1000:8.1f} ms  {module}")
+    if loaded:
+        print(f"create_app() imported {', '.join(loaded)}, which should load lazily")
+        return 1
+    if args.max_ms and elapsed_ms > args.max_ms:
+        print(f"create_app() took longer than {args.max_ms} ms")
+        return 1
+    return 0
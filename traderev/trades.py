@@ -0,0 +1,214 @@
+"""Building trades from opening and closing transactions.
+
+A rebuild is computed as a plan, the difference between the transactions
+and the current trades collection, and then applied as idempotent updates
+keyed on the unique trade key. Rerunning a rebuild, even after a partial
+failure, never inserts or closes a trade twice.
+"""
+import re
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from traderev import db
+from traderev.utils import flatten_dict
+
+def transaction_fees(tr):
+    """Sum of every fee charged on a transaction.
+    """
+    return tr['optregfee'] + tr['regfee'] + tr['additionalfee'] + \
+        tr['cdscfee'] + tr['othercharges'] + tr['rfee'] + tr['secfee']
+
+def trade_doc_from_transaction(tr):
+    """Build a new trade document from its opening transaction.
+    """
+    return {
+        "symbol": tr['symbol'],
+        "underlying": tr['underlying'],
+        "putcall": tr['putcall'],
+        "openingdate": tr['transactiondate'],
+        "closingdate": 0,
+        "openingprice": tr['cost'],
+        "closingprice": 0,
+        "profitdollars": 0,
+        "profitpercent": 0,
+        "totalcommission": tr['commission'],
+        "totalfees": transaction_fees(tr),
+        "openingtransactions": [{
+            "id": tr['id'],
+            "amount": tr['amount']
+        }],
+        "closingtransactions": [],
+        "openamount": tr['amount'],
+        "modified": datetime.utcnow(),
+    }
+
+def plan_trades(pending: bool = False):
+    """Compute the changes needed to bring the trades collection up to date.
+
+    Closing transactions are matched, in date order, to the oldest trade of
+    the symbol which is still open, taking the trades opened by this plan
+    into account. Without an open trade they replace the settlement of the
+    oldest expired trade of the symbol, assignments and exercises can be
+    imported after the settlement.
+
+    Parameters
+    ----------
+        pending : only consider transactions not yet marked as processed,
+            instead of every transaction.
+
+    Returns
+    -------
+        dict : with 'insert' (new trade documents), 'close' (pairs of trade
+            and closing transaction), 'unsettle' (pairs of expired trade and
+            the closing transaction replacing its settlement), 'unmatched'
+            (closing transactions without an open or expired trade) and
+            'tracked' (ids of transactions already part of a trade).
+    """
+    plan = {"insert": [], "close": [], "unsettle": [], "unmatched": [], "tracked": []}
+    opening = db.get_opening_transactions(pending)
+    if pending:
+        opening_ids = db.get_tracked_transaction_ids(
+            "openingtransactions", (tr['id'] for tr in opening))
+    else:
+        opening_ids = set(flatten_dict(db.get_trades_opening_transaction_ids(), "id"))
+    for tr in opening:
+        if tr['id'] in opening_ids:
+            plan["tracked"].append(tr['id'])
+            continue
+        plan["insert"].append(trade_doc_from_transaction(tr))
+
+    open_trades = {}
+    for trade in db.get_open_trades():
+        open_trades.setdefault(trade['symbol'], []).append(trade)
+    for trade in plan["insert"]:
+        open_trades.setdefault(trade['symbol'], []).append(dict(trade))
+    for trades in open_trades.values():
+        trades.sort(key=lambda t: t['openingdate'])
+
+    closing = db.get_closing_transactions(pending)
+    if pending:
+        closing_ids = db.get_tracked_transaction_ids(
+            "closingtransactions", (tr['id'] for tr in closing))
+    else:
+        closing_ids = set(flatten_dict(db.get_trades_closing_transaction_ids(), "id"))
+    settled_trades = {}
+    for tr in closing:
+        if tr['id'] in closing_ids:
+            plan["tracked"].append(tr['id'])
+            continue
+        candidates = open_trades.setdefault(tr['symbol'], [])
+        trade = next((t for t in candidates if t['openamount'] > 0), None)
+        if trade:
+            trade['openamount'] -= tr['amount']
+            plan["close"].append((trade, tr))
+            continue
+        if tr['symbol'] not in settled_trades:
+            settled_trades[tr['symbol']] = list(db.get_settled_trades(tr['symbol']))
+        settled = settled_trades[tr['symbol']]
+        if not settled:
+            plan["unmatched"].append(tr)
+            continue
+        # the trade is open again for what the transaction leaves
+        trade = settled.pop(0)
+        plan["unsettle"].append((trade, tr))
+        trade = dict(trade, openamount=db.settled_amount(trade) - tr['amount'])
+        candidates.append(trade)
+        candidates.sort(key=lambda t: t['openingdate'])
+    return plan
+
+def plan_summary(plan):
+    """Counts describing a plan.
+    """
+    return {
+        "insert": len(plan["insert"]),
+        "close": len(plan["close"]),
+        "unsettle": len(plan["unsettle"]),
+        "unmatched": len(plan["unmatched"]),
+        "tracked": len(plan["tracked"]),
+    }
+
+def processed_ids(plan):
+    """Ids of the transactions a plan leaves part of a trade, unmatched
+    closing transactions stay pending.
+    """
+    ids = list(plan["tracked"])
+    ids.extend(doc['openingtransactions'][0]['id'] for doc in plan["insert"])
+    ids.extend(tr['id'] for _, tr in plan["close"])
+    ids.extend(tr['id'] for _, tr in plan["unsettle"])
+    return ids
+
+def apply_plan(plan, batch_size: int = 1000):
+    """Apply a plan with idempotent updates.
+
+    New trades are upserted with $setOnInsert on their trade key, closing
+    transactions only update a trade which does not list them yet. The
+    settlements are replaced before the closes, which may then close the
+    same trades.
+
+    Returns
+    -------
+        tuple : number of trades inserted and of closing updates applied.
+    """
+    ops = [UpdateOne(db.trade_key(doc), {"$setOnInsert": doc}, upsert=True)
+           for doc in plan["insert"]]
+    ops.extend(UpdateOne(*db.unsettle_trade_update(db.trade_key(trade), trade, tr))
+               for trade, tr in plan["unsettle"])
+    ops.extend(UpdateOne(*db.close_trade_update(db.trade_key(trade), tr))
+               for trade, tr in plan["close"])
+    inserted = 0
+    updated = 0
+    for start in range(0, len(ops), batch_size):
+        res = db.write_trades(ops[start:start + batch_size])
+        inserted += res.upserted_count
+        updated += res.modified_count
+    return inserted, updated
+
+# Option symbols carry the expiration as MMDDYY, e.g. SPY_011523P390
+option_symbol = re.compile(r"_(\d{6})[CP]")
+
+# days after the expiration before an option is settled
+default_grace_days = 3
+
+def option_expiration(symbol: str):
+    """Expiration date of an option symbol, or None for other symbols.
+    """
+    match = option_symbol.search(symbol)
+    if not match:
+        return None
+    try:
+        return datetime.strptime(match.group(1), "%m%d%y")
+    except ValueError:
+        return None
+
+def settle_expired_trades(today: datetime, grace_days: int = default_grace_days):
+    """Close the open trades of options which expired more than grace_days
+    before today.
+
+    The broker sends no transaction when an option expires worthless, the
+    remaining amount is closed at no cost at 20:00 UTC of the expiration
+    date and the trade is flagged as expired. The grace period leaves time
+    for assignment and exercise transactions to be imported, one imported
+    later still replaces the settlement on the next trade build.
+
+    Returns
+    -------
+        tuple : number of open trades scanned and of trades settled.
+    """
+    cutoff = today - timedelta(days=grace_days)
+    ops = []
+    scanned = 0
+    for trade in db.get_open_trades():
+        scanned += 1
+        expiration = option_expiration(trade['symbol'])
+        if not expiration or expiration >= cutoff:
+            continue
+        match = {"_id": trade['_id'], "openamount": {"$gt": 0}}
+        update = {"$set": {
+            "closingdate": expiration + timedelta(hours=20),
+            "openamount": 0,
+            "expired": True,
+            "modified": datetime.utcnow(),
+        }}
+        ops.append(UpdateOne(match, update))
+    if not ops:
+        return scanned, 0
+    return scanned, db.write_trades(ops).modified_count
@@ -1,16 +1,123 @@
-import pandas as pd
+import json
+import math
+import sys
 from typing import Any, Dict, List, Tuple
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from dateutil.rrule import rrule, WEEKLY
-from flask.json import JSONEncoder
-from bson import ObjectId
+from flask.json.provider import DefaultJSONProvider
+from bson import Decimal128, ObjectId
+from werkzeug.http import http_date
 
-class CustomJSONEncoder(JSONEncoder):
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-    def default(self, obj):
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        return JSONEncoder.default(self, obj)
+def json_default(obj):
+    """Serialize the BSON and numpy types found in our documents.
+
+    Datetimes keep the HTTP date format flask has always produced.
+    """
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime):
+        return format_http_datetime(obj)
+    if isinstance(obj, date):
+        return http_date(obj)
+    if isinstance(obj, Decimal128):
+        return finite_or_none(float(obj.to_decimal()))
+    # numpy is only loaded by the stats code path, if it was never imported
+    # there can't be any numpy values to serialize.
+    np = sys.modules.get('numpy')
+    if np is None:
+        return DefaultJSONProvider.default(obj)
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return finite_or_none(float(obj))
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    if isinstance(obj, np.ndarray):
+        return replace_non_finite(obj.tolist())
+    return DefaultJSONProvider.default(obj)
+
+http_weekdays = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+http_months = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep",
+               "Oct", "Nov", "Dec")
+
+def format_http_datetime(dt: datetime) -> str:
+    """Same output as werkzeug's http_date, but several times faster for the
+    naive UTC datetimes pymongo returns.
+    """
+    if dt.tzinfo is not None:
+        return http_date(dt)
+    return f"{http_weekdays[dt.weekday()]}, {dt.day:02d} {http_months[dt.month - 1]} " \
+        f"{dt.year:04d} {dt.hour:02d}:{dt.minute:02d}:{dt.second:02d} GMT"
+
+def finite_or_none(value: float):
+    """NaN and infinity are not valid JSON, report them as null.
+    """
+    if math.isfinite(value):
+        return value
+    return None
+
+def replace_non_finite(obj):
+    """Recursively replace NaN and infinite floats with None.
+    """
+    if isinstance(obj, float):
+        return finite_or_none(obj)
+    if isinstance(obj, dict):
+        return {k: replace_non_finite(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [replace_non_finite(v) for v in obj]
+    return obj
+
+class JSONProvider(DefaultJSONProvider):
+    """JSON provider for BSON heavy responses.
+
+    Uses orjson when it is installed, otherwise falls back to the standard
+    library. The `JSON_BACKEND` config key forces either 'orjson' or 'json'.
+    """
+
+    def __init__(self, app):
+        super().__init__(app)
+        backend = app.config.get('JSON_BACKEND', 'orjson' if orjson else 'json')
+        if backend not in ('orjson', 'json'):
+            raise ValueError(f"Unknown JSON_BACKEND: {backend}")
+        if backend == 'orjson' and not orjson:
+            raise ValueError("JSON_BACKEND 'orjson' requires the orjson package")
+        self.backend = backend
+
+    def dumps_bytes(self, obj, indent: bool = False) -> bytes:
+        """Serialize obj to UTF-8 encoded JSON.
+        """
+        if self.backend == 'orjson':
+            option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME | \
+                orjson.OPT_NON_STR_KEYS
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            if indent:
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=json_default, option=option)
+        separators = None if indent else (",", ":")
+        return json.dumps(replace_non_finite(obj), default=json_default,
+                          ensure_ascii=self.ensure_ascii, sort_keys=self.sort_keys,
+                          indent=2 if indent else None, separators=separators,
+                          allow_nan=False).encode()
+
+    def dumps(self, obj, **kwargs) -> str:
+        return self.dumps_bytes(obj, indent=bool(kwargs.get('indent'))).decode()
+
+    def loads(self, s, **kwargs):
+        if self.backend == 'orjson':
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(
+            self.dumps_bytes(obj, indent) + b"\n", mimetype=self.mimetype)
 
 date_fmt = "%Y-%m-%d"
 def flatten_dict(mappings: List[Dict], field: str) -> List[Any]:
@@ -51,55 +158,6 @@ def week_range(day: str) -> Tuple[datetime, datetime]:
 
     return (week_start, week_end)
 
-def compute_basic_stats(df: pd.DataFrame):
-    """Computes basic trade statistics from a pandas dataframe.
-
-    Parameters
-    ----------
-        df : pd.DataFrame
-
-    Returns
-    -------
-        dict: A dictionary with statistics data
-    """
-    stats = {}
-    stats['total_trades'] = df.shape[0]
-    stats['gross_pnl'] = df['profitdollars'].sum()
-    stats['call_count'] = len(df[df['putcall'] == 'CALL'])
-    stats['put_count'] = len(df[df['putcall'] == 'PUT'])
-    stats['total_commission'] = df['totalcommission'].sum()
-    stats['total_fees'] = df['totalfees'].sum()
-
-    stats['max_gain_dollars'] = df['profitdollars'].max()
-    stats['max_gain_percent'] = df['profitpercent'].max()
-    stats['max_loss_dollars'] = 0
-    stats['max_loss_percent'] = 0
-    stats['avg_loss_percent'] = 0
-    stats['avg_loss_dollars'] = 0
-    stats['avg_gain_dollars'] = 0
-    stats['avg_gain_percent'] = 0
-
-    any_wins = df['profitdollars'] > 0
-    winning_trades = df[any_wins]
-    stats['win_rate'] = len(winning_trades) / df.shape[0] * 100
-    gross_profit = winning_trades['profitdollars'].sum()
-    if any(any_wins):
-        stats['avg_gain_dollars'] = winning_trades['profitdollars'].mean()
-        stats['avg_gain_percent'] = winning_trades['profitpercent'].mean()
-
-    any_loses = df['profitdollars'] < 0
-    losing_trades = df[any_loses]
-    gross_loss = losing_trades['profitdollars'].sum()
-    if any(any_loses):
-        stats['max_loss_dollars'] = losing_trades['profitdollars'].min()
-        stats['max_loss_percent'] = losing_trades['profitpercent'].min()
-        stats['avg_loss_dollars'] = losing_trades['profitdollars'].mean()
-        stats['avg_loss_percent'] = losing_trades['profitpercent'].mean()
-
-    stats['profit_factor'] = gross_profit / gross_loss
-    stats['total_pnl'] = stats['gross_pnl'] - stats['total_commission'] - stats['total_fees']
-    return stats
-
 def weeks_of_year(year: int, until: datetime) -> List[datetime]:
     """Return a list of Monday dates within the given year, up to given date.
 